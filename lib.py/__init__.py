@@ -4,3 +4,5 @@
 XML parsing library for XML5.
 """
 from parser import XMLParser
+from iterparse import iterparse
+from cache import ParseCache
@@ -0,0 +1,778 @@
+#!/usr/bin/env python
+"""Tests of the Python API, for what the tree construction tests can't
+show. testrunner.py runs them after the tree construction tests, or run
+
+  python apitests.py
+"""
+import batch
+import gc
+import hashlib
+import json
+import marshal
+import mmap
+import os
+import shutil
+import tempfile
+import unittest
+
+from cache import ParseCache, fileHeader
+from dtd import DTD, DTDCache, dtds
+from entities import EntityLimits, EntityLimitExceeded
+from inputstream import XMLInputStream, mapFile
+from iterparse import iterparse
+from parser import XMLParser
+from StringIO import StringIO
+from symbols import SymbolTable
+from tokenizer import XMLTokenizer
+from treebuilders import sax, simpletree
+from treebuilders._base import Attribute
+
+class TextHandler(sax.ContentHandler):
+    def __init__(self):
+        self.text = []
+
+    def characters(self, data):
+        self.text.append(data)
+
+class SAXTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        path = os.path.join(self.directory, "greet.dtd")
+        f = open(path, "w")
+        f.write('<!ENTITY who "world">')
+        f.close()
+        dtds.addFile("greet.dtd", path)
+
+    def tearDown(self):
+        del dtds.catalog["greet.dtd"]
+        shutil.rmtree(self.directory)
+
+    def testCatalogIsShared(self):
+        # sax has to use the same parser module, and so the same DTD cache
+        # and symbol table, as everything else
+        source = '<!DOCTYPE r SYSTEM "greet.dtd"><r>&who;</r>'
+        document = XMLParser().parse(source)
+        self.assertEqual(document.childNodes[0].childNodes[0].value,
+          u"world")
+        handler = TextHandler()
+        sax.parse(source, handler)
+        self.assertEqual(u"".join(handler.text), u"world")
+        self.assert_(sax.XMLParser is XMLParser)
+
+class DTDCacheTest(unittest.TestCase):
+    def dtd(self, value):
+        return DTD({"e":value}, {}, [])
+
+    def testLeastRecentlyUsedIsDropped(self):
+        cache = DTDCache(maxSize=2)
+        cache.add("a", self.dtd("1"))
+        cache.add("b", self.dtd("2"))
+        cache.get("a")
+        cache.add("c", self.dtd("3"))
+        self.assertEqual(cache.subsets.keys(), ["a", "c"])
+        self.assertEqual(cache.evictions, 1)
+
+    def testSizeIsBounded(self):
+        cache = DTDCache(maxCharacters=100)
+        for key in "abcde":
+            cache.add(key, self.dtd("x" * 39))
+        self.assertEqual(cache.subsets.keys(), ["d", "e"])
+        self.assertEqual(cache.size, 80)
+        cache.add("f", self.dtd("x" * 200))
+        self.assert_(cache.get("f") is None)
+        self.assertEqual(cache.size, 80)
+
+    def testParsesThroughTheCache(self):
+        cache = DTDCache(maxSize=2)
+        def parse(name):
+            source = '<!DOCTYPE r [<!ENTITY e "%s">]><r>&e;</r>' % name
+            document = XMLParser(dtdCache=cache).parse(source)
+            return document.childNodes[-1].childNodes[0].value
+        for name in ("a", "b", "c", "a"):
+            self.assertEqual(parse(name), name)
+        self.assertEqual(len(cache.subsets), 2)
+        self.assertEqual(cache.evictions, 2)
+
+class CatalogTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        f = open(os.path.join(self.directory, "greet.dtd"), "w")
+        f.write('<!ENTITY who "world">')
+        f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def text(self, dtdCache, doctype):
+        source = "<!DOCTYPE r %s><r>&who;</r>" % doctype
+        document = XMLParser(dtdCache=dtdCache).parse(source)
+        return "".join([node.value
+          for node in document.childNodes[-1].childNodes])
+
+    def testFullIdentifiers(self):
+        cache = DTDCache()
+        cache.loadCatalog(self.directory, "http://example.com/dtd/")
+        self.assertEqual(self.text(cache,
+          'SYSTEM "http://example.com/dtd/greet.dtd"'), "world")
+        for identifier in ("greet.dtd", "http://evil.example/greet.dtd",
+          "../greet.dtd"):
+            self.assertNotEqual(self.text(cache,
+              'SYSTEM "%s"' % identifier), "world")
+
+    def testMatchName(self):
+        cache = DTDCache()
+        cache.loadCatalog(self.directory, matchName=True)
+        for identifier in ("greet.dtd", "http://example.com/greet.dtd"):
+            self.assertEqual(self.text(cache, 'SYSTEM "%s"' % identifier),
+              "world")
+        self.assertNotEqual(self.text(cache, 'SYSTEM "greet.dtd.x"'),
+          "world")
+
+    def testPublicIdentifierIsNotLookedUp(self):
+        cache = DTDCache()
+        cache.loadCatalog(self.directory)
+        self.assertNotEqual(self.text(cache, 'PUBLIC "greet.dtd"'), "world")
+        self.assertEqual(self.text(cache, "PUBLIC 'pub' 'greet.dtd'"),
+          "world")
+        self.assertNotEqual(self.text(cache, 'SYSTEM "x" "greet.dtd"'),
+          "world")
+
+    def testIdentifiers(self):
+        for doctype, expected in [
+          ('PUBLIC "pub" "sys"', ("pub", "sys")),
+          ("PUBLIC 'pub'", ("pub", None)),
+          ('SYSTEM "sys"', (None, "sys")),
+          ('SYSTEM "sys" [<!ENTITY e "x">]', (None, "sys")),
+          ('"sys"', (None, None))]:
+            tokenizer = XMLTokenizer("<!DOCTYPE r %s><r/>" % doctype,
+              dtdCache=None)
+            list(tokenizer)
+            self.assertEqual((tokenizer.publicIdentifier,
+              tokenizer.systemIdentifier), expected)
+
+class ParseCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def key(self, cache, source):
+        return cache.key(source, None, simpletree.TreeBuilder)
+
+    def testLeastRecentlyUsedIsDropped(self):
+        sources = ["<%s>text</%s>" % (name, name) for name in "abc"]
+        cache = ParseCache(maxBytes=1)
+        cache.parse(sources[0])
+        self.assertEqual(len(cache.trees), 0)
+        cache = ParseCache()
+        for source in sources[:2]:
+            cache.parse(source)
+        cache.maxBytes = cache.size
+        cache.parse(sources[0])
+        cache.parse(sources[2])
+        self.assertEqual(cache.trees.keys(),
+          [self.key(cache, sources[0]), self.key(cache, sources[2])])
+        self.assertEqual((cache.hits, cache.misses, cache.evictions),
+          (1, 3, 1))
+
+    def testDiskTier(self):
+        source = '<r a="1"><?p x?><!--c-->text</r>'
+        expected = XMLParser().parse(source).printTree()
+        ParseCache(directory=self.directory).parse(source)
+        cache = ParseCache(directory=self.directory)
+        self.assertEqual(cache.parse(source).printTree(), expected)
+        self.assertEqual((cache.misses, cache.diskHits), (1, 1))
+
+    def testBrokenFileIsAMiss(self):
+        source = "<r>text</r>"
+        expected = XMLParser().parse(source).printTree()
+        cache = ParseCache(directory=self.directory)
+        cache.parse(source)
+        path = cache.path(self.key(cache, source))
+        f = open(path, "rb")
+        written = f.read()
+        f.close()
+        self.assert_(written.startswith(fileHeader))
+        tree = marshal.dumps([1, (99,)])
+        for data in ("", "not a tree", tree, fileHeader + "x" * 20 + tree,
+          written[:-1], written.replace("xml5 tree", "xml6 tree"),
+          fileHeader + hashlib.sha1(tree).digest() + tree[:-1]):
+            f = open(path, "wb")
+            f.write(data)
+            f.close()
+            cache.clear()
+            self.assertEqual(cache.parse(source).printTree(), expected)
+            f = open(path, "rb")
+            self.assertEqual(f.read(), written)
+            f.close()
+        self.assertEqual(cache.diskHits, 0)
+
+    def testDirectoryIsPrivate(self):
+        directory = os.path.join(self.directory, "trees")
+        ParseCache(directory=directory).parse("<r/>")
+        self.assertEqual(os.stat(directory).st_mode & 0777, 0700)
+
+    def testKeyCoversLimitsAndCatalog(self):
+        source = '<!DOCTYPE r SYSTEM "greet.dtd"><r>&who;</r>'
+        dtdCache = DTDCache()
+        cache = ParseCache(dtdCache=dtdCache)
+        key = self.key(cache, source)
+        self.assertNotEqual(self.key(ParseCache(dtdCache=dtdCache,
+          entityLimits=EntityLimits(maxDepth=2)), source), key)
+        self.assertEqual(self.key(ParseCache(dtdCache=dtdCache,
+          entityLimits=EntityLimits()), source), key)
+        path = os.path.join(self.directory, "greet.dtd")
+        for value in ("world", "there"):
+            f = open(path, "w")
+            f.write('<!ENTITY who "%s">' % value)
+            f.close()
+            dtdCache.addFile("greet.dtd", path)
+            self.assertNotEqual(self.key(cache, source), key)
+            key = self.key(cache, source)
+            document = cache.parse(source)
+            self.assertEqual(document.childNodes[-1].childNodes[0].value,
+              value)
+
+class EntityExpansionTest(unittest.TestCase):
+    def billionLaughs(self, depth):
+        entities = ['<!ENTITY lol0 "lol">'] + ['<!ENTITY lol%d "%s">' %
+          (i, ("&lol%d;" % (i - 1)) * 10) for i in xrange(1, depth + 1)]
+        return "<!DOCTYPE lolz [%s]><lolz>&lol%d;</lolz>" % (
+          "".join(entities), depth)
+
+    def testExpansionIsCutOff(self):
+        parser = XMLParser()
+        document = parser.parse(self.billionLaughs(9))
+        limits = EntityLimits()
+        self.assert_(parser.entityStats.dropped > 0)
+        self.assert_(parser.entityStats.characters <
+          limits.ratioThreshold + 10 ** 4)
+        text = document.childNodes[0].childNodes[0].value
+        self.assert_(0 < len(text) <= parser.entityStats.characters)
+
+    def testExpansionIsOneToken(self):
+        # However deeply the references nest, the text is a single token
+        tokens = list(XMLTokenizer(self.billionLaughs(3)))
+        self.assertEqual([token["type"] for token in tokens],
+          ["StartTag", "Characters", "EndTag"])
+        self.assertEqual(tokens[1].data, "lol" * 1000)
+
+    def testAbort(self):
+        parser = XMLParser(entityLimits=EntityLimits(policy="abort"))
+        self.assertRaises(EntityLimitExceeded, parser.parse,
+          self.billionLaughs(9))
+
+    def testMaxParameterEntities(self):
+        # With a cache the first parse, which has no limit on parameter
+        # entities, caches the subset. The cached DTD expanded three, more
+        # than the later parses allow, so they parse the subset again and
+        # stop at two.
+        source = ('<!DOCTYPE r [<!ENTITY % p "<!ENTITY e \'x\'>">'
+          '%p;%p;%p;]><r>&e;</r>')
+        for dtdCache in (None, DTDCache()):
+            parser = XMLParser(dtdCache=dtdCache,
+              entityLimits=EntityLimits(maxParameterEntities=None))
+            parser.parse(source)
+            self.assertEqual(parser.entityStats.parameterEntities, 3)
+            if dtdCache is not None:
+                self.assertEqual(len(dtdCache.subsets), 1)
+            for i in xrange(2):
+                parser = XMLParser(dtdCache=dtdCache,
+                  entityLimits=EntityLimits(maxParameterEntities=2))
+                document = parser.parse(source)
+                self.assertEqual(parser.entityStats.parameterEntities, 2)
+                self.assertEqual(parser.entityStats.dropped, 1)
+                self.assertEqual(document.childNodes[-1].childNodes[0].value,
+                  "x")
+            parser = XMLParser(dtdCache=dtdCache, entityLimits=EntityLimits(
+              maxParameterEntities=2, policy="abort"))
+            self.assertRaises(EntityLimitExceeded, parser.parse, source)
+
+class FeedTest(unittest.TestCase):
+    chunkSize = 1024
+
+    def assertResumes(self, document):
+        # After each chunk the checkpoint, where the next feed starts
+        # scanning from, should be close to the end of what was fed. Before
+        # the tokenizer resumed inside tokens it stayed at the start of the
+        # token, so every feed scanned all of it again.
+        parser = XMLParser()
+        for i in xrange(0, len(document), self.chunkSize):
+            parser.feed(document[i:i + self.chunkSize])
+            offset = parser.tokenizer.checkpoint[1][0]
+            fed = min(i + self.chunkSize, len(document))
+            self.assert_(fed - offset <= self.chunkSize,
+              "checkpoint at %d after %d characters" % (offset, fed))
+        self.assertEqual(parser.close().printTree(),
+          XMLParser().parse(document).printTree())
+
+    # Each body is some 64 chunks long, with the characters that end a scan
+    # every so often
+    def body(self, separator):
+        return ("x" * 63 + separator) * (1 << 10)
+
+    def testLongAttributeValue(self):
+        self.assertResumes('<r a="%s"/>' % self.body("&amp;"))
+
+    def testLongComment(self):
+        self.assertResumes("<r><!--%s--></r>" % self.body("-"))
+
+    def testLongPi(self):
+        self.assertResumes("<r><?p %s?></r>" % self.body("?"))
+
+    def testLongCdata(self):
+        self.assertResumes("<r><![CDATA[%s]]></r>" %
+          self.body("]"))
+
+class PositionTest(unittest.TestCase):
+    source = ('<r a="1">\r\nline\r\n<!--c\r\nd-->\r\n<x/>\r\n\r\n'
+      '<?p q?></r>')
+
+    def spans(self, document):
+        return [(node.nodeType, node.span) for node in document]
+
+    def parseAll(self, source, chunkSize=1):
+        """Returns the spans of the nodes of source parsed whole, fed
+        chunkSize bytes at a time and scanned as bytes, which must be the
+        same for ASCII."""
+        parser = XMLParser(trackPositions=True)
+        for i in xrange(0, len(source), chunkSize):
+            parser.feed(source[i:i + chunkSize])
+        fed = self.spans(parser.close())
+        whole = self.spans(XMLParser(trackPositions=True).parse(source))
+        scanned = self.spans(XMLParser(trackPositions=True,
+          scanBytes=True).parse(source))
+        self.assertEqual(fed, whole)
+        self.assertEqual(scanned, whole)
+        return whole
+
+    def testTokenSpans(self):
+        tokens = [(token["type"], token.span) for token in
+          XMLTokenizer(self.source, trackPositions=True)]
+        self.assertEqual(tokens, [
+          ("StartTag", ((1, 0, 0), (1, 9, 9))),
+          ("Characters", ((1, 9, 9), (3, 0, 15))),
+          ("Comment", ((3, 0, 15), (4, 4, 25))),
+          ("Characters", ((4, 4, 25), (5, 0, 26))),
+          ("EmptyTag", ((5, 0, 26), (5, 4, 30))),
+          ("Characters", ((5, 4, 30), (7, 0, 32))),
+          ("Pi", ((7, 0, 32), (7, 7, 39))),
+          ("EndTag", ((7, 7, 39), (7, 11, 43)))])
+        tokenizer = XMLTokenizer(None, trackPositions=True)
+        fed = []
+        for c in self.source:
+            fed.extend(tokenizer.feed(c))
+        fed.extend(tokenizer.close())
+        # Fed text comes in pieces as it arrives, each spanning its own part
+        merged = []
+        for token in fed:
+            if merged and token["type"] == merged[-1][0] == "Characters":
+                self.assertEqual(token.span[0], merged[-1][1][1])
+                merged[-1] = ("Characters", (merged[-1][1][0], token.span[1]))
+            else:
+                merged.append((token["type"], token.span))
+        self.assertEqual(merged, tokens)
+
+    def testNodeSpans(self):
+        self.assertEqual(self.parseAll(self.source), [
+          (1, ((1, 0, 0), (7, 11, 43))),
+          (3, ((1, 9, 9), (3, 0, 15))),
+          (8, ((3, 0, 15), (4, 4, 25))),
+          (3, ((4, 4, 25), (5, 0, 26))),
+          (1, ((5, 0, 26), (5, 4, 30))),
+          (3, ((5, 4, 30), (7, 0, 32))),
+          (7, ((7, 0, 32), (7, 7, 39)))])
+
+    def testCrlfAcrossChunks(self):
+        # The CR is the last byte of the first chunk of the stream and the
+        # LF the first of the next; fed in chunks of 4095 bytes some CRLFs
+        # are split between feeds too
+        size = XMLInputStream.chunkSize
+        source = "<r>%s\r\n<a/>\ry\r\n%s</r>" % ("x" * (size - 4),
+          "z\r\n" * 2000)
+        spans = self.parseAll(source, 4095)
+        self.assertEqual(spans[1:4], [
+          (3, ((1, 3, 3), (2, 0, size))),
+          (1, ((2, 0, size), (2, 4, size + 4))),
+          (3, ((2, 4, size + 4), (2004, 0, size + 4007)))])
+        self.assertEqual(spans[0][1][1], (2004, 4, size + 4011))
+
+    def testLocation(self):
+        source = "<r>\r\nab\rc\n\r\nd</r>"
+        expected = [(1, 0, 0), (1, 3, 3), (2, 0, 4), (2, 2, 6), (3, 0, 7),
+          (3, 1, 8), (4, 0, 9), (5, 0, 10), (5, 1, 11)]
+        tokenizer = XMLTokenizer(source, trackPositions=True)
+        list(tokenizer)
+        self.assertEqual([tokenizer.stream.location(location[2])
+          for location in expected], expected)
+        self.assertEqual(tokenizer.stream.location(), (5, 5, 15))
+        tokenizer = XMLTokenizer(None, trackPositions=True)
+        for c in source:
+            tokenizer.feed(c)
+        tokenizer.close()
+        self.assertEqual([tokenizer.stream.location(location[2])
+          for location in expected], expected)
+
+    def testBytesAreCounted(self):
+        # With scanBytes offsets count bytes, lines and columns don't change
+        source = "<r>\xc3\xa9\r\n<a/></r>"
+        characters = self.spans(XMLParser(trackPositions=True).parse(source))
+        scanned = self.spans(XMLParser(trackPositions=True,
+          scanBytes=True).parse(source))
+        self.assertEqual(characters[2], (1, ((2, 0, 5), (2, 4, 9))))
+        self.assertEqual(scanned[2], (1, ((2, 0, 6), (2, 4, 10))))
+
+class BatchTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.files = {}
+        for name, data in [("a/small.xml", "<r/>"),
+          ("a/b/large.xml", "<r>%s</r>" % ("<x>&amp;</x>" * 100)),
+          ("medium.xml", "<r><x/><x/></r>"), ("notes.txt", "<!--t--><n/>")]:
+            path = self.path(name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            f = open(path, "w")
+            f.write(data)
+            f.close()
+            self.files[name] = data
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, *name.split("/"))
+
+    def testFindFiles(self):
+        listing = self.path("list.txt")
+        f = open(listing, "w")
+        f.write("%s\n\n  %s  \n" % (self.path("notes.txt"),
+          self.path("missing.xml")))
+        f.close()
+        self.assertEqual(batch.findFiles([self.path("a"),
+          os.path.join(self.directory, "*.xml"), "@" + listing,
+          self.path("a/small.xml")]),
+          [self.path(name) for name in ("a/small.xml", "a/b/large.xml",
+          "medium.xml", "notes.txt", "missing.xml")])
+
+    def results(self, workers):
+        paths = [self.path(name) for name in sorted(self.files)] +\
+          [self.path("missing.xml")]
+        return list(batch.parseFiles(paths, workers, method="tree"))
+
+    def testInProcess(self):
+        results = self.results(1)
+        # Largest first, the missing file with a size of 0 last
+        self.assertEqual([result[0] for result in results],
+          [self.path(name) for name in ("a/b/large.xml", "medium.xml",
+          "notes.txt", "a/small.xml", "missing.xml")])
+        for path, size, seconds, errors, entityStats, document, failure in\
+          results[:-1]:
+            self.assertEqual(size, os.path.getsize(path))
+            self.assertEqual(failure, None)
+            self.assertEqual(document.decode("utf-8"),
+              XMLParser().parseFile(path).printTree())
+        self.assertEqual(results[0][4]["entities"], 100)
+        path, size, seconds, errors, entityStats, document, failure =\
+          results[-1]
+        self.assertEqual((size, document), (None, None))
+        self.assert_(failure.startswith("OSError"), failure)
+
+    def testPool(self):
+        def withoutTimes(results):
+            return sorted([result[:2] + result[3:] for result in results])
+        self.assertEqual(withoutTimes(self.results(2)),
+          withoutTimes(self.results(1)))
+
+    def testWorkerKeepsItsParser(self):
+        batch.initWorker("none")
+        parser = batch.workerParser
+        self.assert_(isinstance(parser, XMLParser))
+        for name in ("medium.xml", "a/small.xml"):
+            result = batch.parseOne(self.path(name))
+            self.assertEqual((result[5], result[6]), (None, None))
+            self.assert_(batch.workerParser is parser)
+
+    def testMain(self):
+        output = self.path("results.json")
+        status = batch.main(["-j", "1", "-m", "xml", "-o", output,
+          self.path("a"), self.path("missing.xml")])
+        self.assertEqual(status, 1)
+        f = open(output)
+        results = [json.loads(line) for line in f]
+        f.close()
+        self.assertEqual([result["path"] for result in results],
+          [self.path("a/b/large.xml"), self.path("a/small.xml"),
+          self.path("missing.xml")])
+        self.assertEqual(results[1]["document"], "<r/>")
+        self.assertEqual(results[1]["failure"], None)
+        self.assert_("document" not in results[2])
+        self.assert_(results[2]["failure"].startswith("OSError"))
+
+class ParseFileTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, data):
+        path = os.path.join(self.directory, "document.xml")
+        f = open(path, "wb")
+        f.write(data)
+        f.close()
+        return path
+
+    def testMapped(self):
+        # Longer than a chunk of the input stream, so it is read in pieces
+        data = "<r>%s</r>" % ('<x a="1">text &amp; more</x>' * 10000)
+        path = self.write(data)
+        source = mapFile(path)
+        self.assert_(isinstance(source, mmap.mmap))
+        source.close()
+        self.assertEqual(XMLParser().parseFile(path).printTree(),
+          XMLParser().parse(data).printTree())
+
+    def testEmpty(self):
+        path = self.write("")
+        source = mapFile(path)
+        self.assert_(not isinstance(source, mmap.mmap))
+        source.close()
+        self.assertEqual(XMLParser().parseFile(path).printTree(),
+          "#document")
+
+    def testEncodingDeclaration(self):
+        path = self.write('<?xml version="1.0" encoding="iso-8859-1"?>'
+          '<r a="\xe9">\xe9t\xe9</r>')
+        root = XMLParser().parseFile(path).childNodes[-1]
+        self.assertEqual(root.attributes[0].value, u"\xe9")
+        self.assertEqual(root.childNodes[0].value, u"\xe9t\xe9")
+        root = XMLParser().parseFile(path, "utf-8").childNodes[-1]
+        self.assertNotEqual(root.childNodes[0].value, u"\xe9t\xe9")
+
+class CompatibilityTest(unittest.TestCase):
+    # Attributes used to be dictionaries and nodes plain objects
+
+    def parse(self):
+        return XMLParser().parse('<r xmlns:b="urn:b" b:a="1" c="2">t<!--c-->'
+          '<?p d?></r>')
+
+    def testAttributesAsDictionaries(self):
+        attributes = self.parse().childNodes[0].attributes
+        self.assertEqual([attribute["name"] for attribute in attributes],
+          ["xmlns:b", "b:a", "c"])
+        attribute = attributes[1]
+        self.assertEqual(dict(attribute.items()), {"name":"b:a",
+          "localname":"a", "prefix":"b", "namespace":"urn:b", "value":"1"})
+        self.assertEqual(sorted(attribute), sorted(attribute.keys()))
+        self.assertEqual(sorted(attribute.keys()), ["localname", "name",
+          "namespace", "prefix", "value"])
+        self.assertEqual(attribute.values(),
+          [attribute[key] for key in attribute.keys()])
+        self.assertEqual(len(attribute), 5)
+        self.assert_("value" in attribute)
+        self.assert_("other" not in attribute)
+        self.assertEqual(attribute.get("namespace"), "urn:b")
+        self.assertEqual(attribute.get("other", "x"), "x")
+        self.assertRaises(KeyError, lambda: attribute["other"])
+        attribute["value"] = "3"
+        self.assertEqual((attribute.value, attribute["value"]), ("3", "3"))
+        self.assertRaises(KeyError, attribute.__setitem__, "other", "x")
+
+    def testSAXAttributes(self):
+        class Handler(sax.ContentHandler):
+            def startElement(self, name, prefix, localname, namespace,
+              attributes):
+                self.attributes = dict([(attribute["name"],
+                  attribute["value"]) for attribute in attributes])
+        handler = Handler()
+        sax.parse('<r a="1" b="2"/>', handler)
+        self.assertEqual(handler.attributes, {"a":"1", "b":"2"})
+
+    def testNodes(self):
+        document = self.parse()
+        root = document.childNodes[0]
+        text, comment, pi = root.childNodes
+        self.assertEqual((root.name, text.value, comment.data, pi.name,
+          pi.data), ("r", "t", "c", "p", "d"))
+        for node in (text, comment, pi):
+            self.assertEqual(list(node.childNodes), [])
+        # Nodes and attributes are slotted, so only the attributes they
+        # define can be set
+        for node in (document, root, text, comment, pi, root.attributes[0]):
+            self.assertRaises(AttributeError, setattr, node, "other", 1)
+        text.value = "u"
+        self.assertEqual(root.toxml(), '<r xmlns:b="urn:b" b:a="1" c="2">u'
+          '<!--c--><?p d?></r>')
+
+class SerializerTest(unittest.TestCase):
+    def assertRoundTrips(self, source):
+        document = XMLParser().parse(source)
+        again = XMLParser().parse(document.toxml())
+        self.assertEqual(again.printTree(), document.printTree())
+        self.assertEqual(again.toxml(), document.toxml())
+
+    def testSubtree(self):
+        document = XMLParser().parse(
+          '<r><a x="1">one<b/></a><!--c--><?p d?></r>')
+        root = document.childNodes[0]
+        self.assertEqual(root.childNodes[0].toxml(), u'<a x="1">one<b/></a>')
+        self.assertEqual(root.childNodes[0].childNodes[1].toxml(), u"<b/>")
+        self.assertEqual(root.childNodes[1].toxml(), u"<!--c-->")
+        self.assertEqual(root.childNodes[2].toxml(), u"<?p d?>")
+
+    def testNamespaces(self):
+        self.assertRoundTrips('<r xmlns="urn:a" xmlns:b="urn:b"><b:x b:y="1">'
+          '<x xmlns:b="urn:c" b:z="2"/></b:x><y xml:lang="en"/></r>')
+
+    def testEscapedAttributes(self):
+        document = XMLParser().parse(
+          '<r a="&amp;&lt;&gt;&quot;\'" b=\'"\'>&amp;&lt;&gt;</r>')
+        self.assertEqual(document.toxml(),
+          '<r a="&amp;&lt;&gt;&quot;\'" b="&quot;">&amp;&lt;&gt;</r>')
+        self.assertRoundTrips(document.toxml())
+
+    def testPis(self):
+        self.assertRoundTrips('<?a b?><r><?c d e?><?f?>x<?g h?></r><?i j?>')
+
+    def testSerializeMatchesToxml(self):
+        source = '<r xmlns:b="urn:b" a="&amp;">\xc3\xa9<!--c--><b:x/></r>'
+        document = XMLParser().parse(source)
+        stream = StringIO()
+        document.serialize(stream)
+        self.assertEqual(stream.getvalue(), document.toxml())
+
+class ElementIndexTest(unittest.TestCase):
+    source = ('<r xmlns="urn:a" xmlns:b="urn:b"><x id="1"/><b:x xml:id="2">'
+      '<y id="3"><x/></y></b:x><y xmlns="urn:c"/></r>')
+
+    def parse(self, tree):
+        return XMLParser(tree=tree).parse(self.source)
+
+    def lookups(self, document):
+        return ([x.namespace for x in document.getElementsByTagName("x")],
+          [y.namespace for y in document.getElementsByTagName("y")],
+          [x.name for x in document.getElementsByTagNameNS("urn:a", "x")],
+          [x.name for x in document.getElementsByTagNameNS("urn:b", "x")],
+          [y.name for y in document.getElementsByTagNameNS("urn:c", "y")],
+          [getattr(document.getElementById(id), "name", None)
+            for id in ("1", "2", "3", "4")])
+
+    def testLookups(self):
+        document = self.parse(simpletree.IndexedTreeBuilder)
+        self.assert_(document.index is not None)
+        self.assertEqual(self.lookups(document),
+          (["urn:a", "urn:a"], ["urn:a", "urn:c"], ["x", "x"], ["b:x"], ["y"],
+          ["x", "b:x", "y", None]))
+        self.assertEqual(self.lookups(document),
+          self.lookups(self.parse(simpletree.TreeBuilder)))
+
+    def testRemovedNodesAreDropped(self):
+        document = self.parse(simpletree.IndexedTreeBuilder)
+        unindexed = self.parse(simpletree.TreeBuilder)
+        for d in (document, unindexed):
+            root = d.childNodes[0]
+            # Removing b:x takes y and the x inside it along
+            root.removeChild(root.childNodes[1])
+        self.assertEqual(self.lookups(document), self.lookups(unindexed))
+        self.assertEqual(self.lookups(document),
+          (["urn:a"], ["urn:c"], ["x"], [], ["y"], ["x", None, None, None]))
+        for d in (document, unindexed):
+            d.childNodes[0].clear()
+        self.assertEqual(self.lookups(document), self.lookups(unindexed))
+        self.assertEqual(document.getElementsByTagName("x"), [])
+        self.assertEqual(document.index.byName["x"], [])
+
+    def testAddedElements(self):
+        document = self.parse(simpletree.IndexedTreeBuilder)
+        root = document.childNodes[0]
+        element = simpletree.Element("z", "", "z", "urn:a",
+          [Attribute("id", "id", "", "", "5")])
+        root.childNodes[0].appendChild(element)
+        x = simpletree.Element("x", "", "x", "urn:a", None)
+        root.appendChild(x)
+        # Found by walking the tree, as the index has none of them
+        self.assert_(document.getElementById("5") is element)
+        self.assertEqual(document.getElementsByTagName("z"), [element])
+        self.assertEqual(document.getElementsByTagNameNS("urn:a", "z"),
+          [element])
+        # The index has other x elements, so this one is missed until the
+        # document is reindexed
+        self.assert_(x not in document.getElementsByTagName("x"))
+        document.reindex()
+        self.assertEqual(document.getElementsByTagName("x")[-1], x)
+        self.assertEqual(self.lookups(document), self.lookups(
+          XMLParser().parse(document.toxml())))
+
+    def testDeepRemoval(self):
+        source = "<r>%s%s</r>" % ("<d>" * 200 + "<x/>" * 50 + "</d>" * 200,
+          "<d><x/></d>" * 50)
+        document = XMLParser(tree=simpletree.IndexedTreeBuilder).parse(source)
+        self.assertEqual(len(document.getElementsByTagName("x")), 100)
+        deep = document.childNodes[0].childNodes[0].childNodes[0]
+        deep.parent.removeChild(deep)
+        self.assertEqual(len(document.getElementsByTagName("x")), 50)
+        self.assertEqual(len(document.getElementsByTagName("d")), 51)
+
+class IterparseTest(unittest.TestCase):
+    def testEventOrder(self):
+        source = "<a><b/><!--c--><?p d?><e>t</e></a>"
+        events = [(event, getattr(node, "name", None) or node.data)
+          for event, node in iterparse(source,
+          ("start", "end", "comment", "pi"))]
+        self.assertEqual(events, [("start", "a"), ("start", "b"),
+          ("end", "b"), ("comment", "c"), ("pi", "p"), ("start", "e"),
+          ("end", "e"), ("end", "a")])
+        events = [(event, node.name)
+          for event, node in iterparse(source, ("end",))]
+        self.assertEqual(events, [("end", "b"), ("end", "e"), ("end", "a")])
+
+    def testUnclosedElementsAreEnded(self):
+        events = [(event, node.name)
+          for event, node in iterparse("<a><b>", ("end",))]
+        self.assertEqual(events, [("end", "b"), ("end", "a")])
+
+    def liveRecords(self):
+        gc.collect()
+        return len([node for node in gc.get_objects()
+          if isinstance(node, simpletree.Element) and
+          node.name == "record"])
+
+    def testClearedElementsAreFreed(self):
+        source = "<records>%s</records>" % (
+          "<record><field>x</field></record>" * 2000)
+        counts = []
+        count = 0
+        for event, element in iterparse(source, ("end",)):
+            if element.name == "record":
+                element.parent.clear()
+                count += 1
+                if count % 500 == 0:
+                    counts.append(self.liveRecords())
+        del event, element
+        self.assertEqual(count, 2000)
+        self.assert_(max(counts) < 10, counts)
+
+class SymbolTableTest(unittest.TestCase):
+    def testValuesDontStarveNames(self):
+        table = SymbolTable(maxSize=10, maxValues=10)
+        for i in xrange(100):
+            table.internValue("value%d" % i)
+        self.assert_(len(table.values) <= 10)
+        name = "".join(["na", "me"])
+        self.assert_(table.intern(name) is name)
+        self.assert_(table.intern("".join(["na", "me"])) is name)
+
+    def testRecentValuesAreKept(self):
+        table = SymbolTable(maxValues=10)
+        for i in xrange(25):
+            table.internValue("value%d" % i)
+        value = "".join(["value", "24"])
+        self.assert_(table.internValue(value) is not value)
+
+def suite():
+    return unittest.defaultTestLoader.loadTestsFromName("apitests")
+
+if __name__ == "__main__":
+    unittest.main()
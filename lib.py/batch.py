@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+"""Parses many documents over a pool of worker processes.
+
+  python batch.py records/ "feeds/*.xml" @more-files.txt
+
+Arguments are files, directories (every file below them), glob patterns or
+@ followed by a file that lists one path per line. The largest files are
+parsed first so a big file doesn't hold up the end of the run. Each worker
+keeps one XMLParser for all of its documents.
+
+Results are written as JSON, one line per file in the order the files are
+done: the path, its size, the time the parse took, the parse errors, the
+entity expansion counts and, unless --method is "none", the document
+serialized with that method. Workers send back the serialized document
+rather than the tree, which is much cheaper to pickle.
+"""
+
+import glob
+import os
+import sys
+import time
+
+from cStringIO import StringIO
+
+import serializer
+from parser import XMLParser
+
+# The parser each worker process reuses, set by initWorker()
+workerParser = None
+workerMethod = None
+
+def findFiles(arguments):
+    """Returns the paths the command line arguments stand for, without
+    duplicates, in the order they were found."""
+    paths = []
+    for argument in arguments:
+        if argument.startswith("@"):
+            listing = open(argument[1:])
+            try:
+                paths.extend([line.strip() for line in listing
+                  if line.strip()])
+            finally:
+                listing.close()
+        elif os.path.isdir(argument):
+            for directory, directories, files in os.walk(argument):
+                directories.sort()
+                paths.extend([os.path.join(directory, name)
+                  for name in sorted(files)])
+        elif glob.has_magic(argument):
+            paths.extend(sorted(glob.glob(argument)))
+        else:
+            paths.append(argument)
+    seen = set()
+    unique = []
+    for path in paths:
+        if path not in seen:
+            seen.add(path)
+            unique.append(path)
+    return unique
+
+def initWorker(method):
+    global workerParser, workerMethod
+    workerParser = XMLParser()
+    workerMethod = method
+
+def parseOne(path):
+    """Parses the file at path with the worker's parser and returns a tuple
+    of the path, its size, the seconds the parse took, the errors, the
+    EntityStats counts by name, the serialized document as UTF-8 and the
+    message of the exception that stopped the parse, if any."""
+    size = seconds = None
+    document = errors = entityStats = failure = None
+    try:
+        size = os.path.getsize(path)
+        start = time.time()
+        tree = workerParser.parseFile(path)
+        seconds = time.time() - start
+        errors = list(workerParser.errors)
+        stats = workerParser.entityStats
+        entityStats = dict([(name, getattr(stats, name))
+          for name in stats.__slots__])
+        if workerMethod != "none":
+            out = StringIO()
+            serializer.serialize(tree, out, "utf-8", workerMethod)
+            document = out.getvalue()
+    except Exception, e:
+        failure = "%s: %s" % (e.__class__.__name__, e)
+    return (path, size, seconds, errors, entityStats, document, failure)
+
+def parseFiles(paths, workers=None, chunkSize=1, method="xml"):
+    """Parses paths over a pool of worker processes, the number of CPUs by
+    default or in this process if workers is 1, and yields the tuples of
+    parseOne() as the files are done. chunkSize files are sent to a worker
+    at a time."""
+    sizes = {}
+    for path in paths:
+        try:
+            sizes[path] = os.path.getsize(path)
+        except OSError:
+            # Reported by the worker
+            sizes[path] = 0
+    paths = sorted(paths, key=lambda path: sizes[path], reverse=True)
+    if workers == 1:
+        initWorker(method)
+        for path in paths:
+            yield parseOne(path)
+        return
+    import multiprocessing
+    pool = multiprocessing.Pool(workers, initWorker, (method,))
+    try:
+        for result in pool.imap_unordered(parseOne, paths, chunkSize):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+def main(argv=None):
+    import json
+    from optparse import OptionParser
+    optionParser = OptionParser(
+      usage="%prog [options] file|directory|glob|@list ...")
+    optionParser.add_option("-j", "--workers", type="int",
+      help="number of worker processes [number of CPUs]")
+    optionParser.add_option("-c", "--chunk-size", dest="chunkSize",
+      type="int", default=1,
+      help="files sent to a worker at a time [%default]")
+    optionParser.add_option("-m", "--method", default="xml",
+      help="serialize documents as xml, hilite, tree or none [%default]")
+    optionParser.add_option("-o", "--output",
+      help="write the results to this file instead of stdout")
+    options, args = optionParser.parse_args(argv)
+    if not args:
+        optionParser.error("no files given")
+    if options.method != "none" and options.method not in serializer.methods:
+        optionParser.error("unknown method %r" % options.method)
+
+    if options.output:
+        out = open(options.output, "w")
+    else:
+        out = sys.stdout
+    failed = 0
+    for (path, size, seconds, errors, entityStats, document,
+      failure) in parseFiles(findFiles(args), options.workers,
+      options.chunkSize, options.method):
+        result = {
+          "path":path,
+          "size":size,
+          "seconds":seconds,
+          "errors":errors,
+          "entityStats":entityStats,
+          "failure":failure
+        }
+        if document is not None:
+            result["document"] = document.decode("utf-8")
+        if failure is not None:
+            failed += 1
+        json.dump(result, out, sort_keys=True)
+        out.write("\n")
+    if options.output:
+        out.close()
+    return failed and 1 or 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+"""Throughput benchmarks for the XML5 parser.
+
+Each corpus is generated at the requested sizes and run through four
+stages, each in a fresh worker process so peak RSS can be attributed to a
+single stage:
+
+  inputstream  decoding and normalization by XMLInputStream
+  tokenizer    iterating over XMLTokenizer without building a tree
+  tree         XMLParser.parse into a simpletree document
+  memory       the memory held by the finished document, per node
+
+Results are written as JSON so runs on different commits can be compared.
+
+  python bench.py --sizes 16,128 --corpora flat,entities -o results.json
+"""
+
+import gc
+import os
+import resource
+import sys
+import time
+
+from constants import EOF
+from inputstream import XMLInputStream, UTF8InputStream
+from tokenizer import XMLTokenizer
+from parser import XMLParser
+
+stages = ("inputstream", "tokenizer", "tree", "memory")
+
+# What the inputstream stage reads up to, as the data state of the tokenizer
+# does between markup
+inputStreamStop = frozenset((u"<",))
+
+# Corpus generators. Each one takes a target size in bytes and returns a
+# byte string of roughly that size.
+
+def flatCorpus(size):
+    records = []
+    length = 0
+    i = 0
+    while length < size:
+        record = ('<record id="%d"><name>Item %d</name><price currency="EUR">'
+          '%d.%02d</price><note>plain text for record %d</note></record>\n'
+          % (i, i, i % 1000, i % 100, i))
+        records.append(record)
+        length += len(record)
+        i += 1
+    return "<records>\n" + "".join(records) + "</records>"
+
+def crlfCorpus(size):
+    # The flat corpus with Windows line breaks and the odd NUL, so every
+    # chunk has to be normalized.
+    return flatCorpus(size).replace("\n", "\r\n").replace("</note>",
+      "\x00</note>", 1)
+
+def deepCorpus(size):
+    # Nest to a fixed depth and repeat, so the cost of deep open element
+    # stacks shows up without the document degenerating into one branch.
+    depth = 200
+    block = "".join(['<n d="%d">t' % i for i in xrange(depth)]) +\
+      "</n>" * depth + "\n"
+    return "<root>" + block * (size // len(block) + 1) + "</root>"
+
+def attributesCorpus(size):
+    attributes = " ".join(['a%d="value %d"' % (i, i) for i in xrange(24)])
+    element = "<e %s/>\n" % attributes
+    return "<root>" + element * (size // len(element) + 1) + "</root>"
+
+def entitiesCorpus(size):
+    names = ["e%d" % i for i in xrange(16)]
+    subset = "".join(['<!ENTITY %s "entity %s text">' % (name, name)
+      for name in names])
+    subset += '<!ENTITY nested "&e0; and &e1;">'
+    line = "<p>" + " ".join(["&%s;" % name for name in names]) +\
+      " &nested; &amp; &lt; &#65; &#x42;</p>\n"
+    return "<!DOCTYPE root [%s]><root>" % subset +\
+      line * (size // len(line) + 1) + "</root>"
+
+def dtdCorpus(size):
+    # Defaults declared for a few hundred elements, most of which the
+    # document uses, so applying them has to find the right declarations
+    # among many.
+    elements = 300
+    subset = "".join(['<!ATTLIST e%d a CDATA #FIXED "a%d" b CDATA #FIXED '
+      '"b%d">' % (i, i, i) for i in xrange(elements)])
+    line = "".join(['<e%d a="own">text</e%d>' % (i, i)
+      for i in xrange(0, elements, 7)]) + "\n"
+    return "<!DOCTYPE root [%s]><root>" % subset +\
+      line * (size // len(line) + 1) + "</root>"
+
+def namespacesCorpus(size):
+    entry = ('<entry xmlns:dc="http://purl.org/dc/elements/1.1/">'
+      '<title type="text">Title</title><dc:creator>Someone</dc:creator>'
+      '<link rel="alternate" href="http://example.org/"/>'
+      '<x:meta xmlns:x="urn:x" x:a="1" dc:b="2"><x:k>v</x:k></x:meta>'
+      '</entry>\n')
+    return '<feed xmlns="http://www.w3.org/2005/Atom">' +\
+      entry * (size // len(entry) + 1) + "</feed>"
+
+def tagsoupCorpus(size):
+    # Every line ends in ";" so a stray "&" can't swallow the rest of the
+    # document as one entity name, and the </div> closes whatever was left
+    # open so the stack of open elements stays shallow.
+    soup = ('<div><p>unclosed <b>bold <i>italic</b> text</p>;\n'
+      '<a href=foo title=bar&baz>link</>;\n'
+      '< stray <br/ > & lone ampersand </x y>;\n'
+      '<!bogus comment><?pi ?><![CDATA[ raw ]]> </ >;</div>\n')
+    return "<html>" + soup * (size // len(soup) + 1)
+
+corpora = {
+  "flat":flatCorpus,
+  "crlf":crlfCorpus,
+  "deep":deepCorpus,
+  "attributes":attributesCorpus,
+  "entities":entitiesCorpus,
+  "dtd":dtdCorpus,
+  "namespaces":namespacesCorpus,
+  "tagsoup":tagsoupCorpus
+}
+
+def peakRSS():
+    """Returns the peak resident set size of this process in kilobytes."""
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        # Reported in bytes rather than kilobytes.
+        usage //= 1024
+    return usage
+
+def currentRSS():
+    """Returns the resident set size of this process in kilobytes, or the
+    peak if the current size can't be read."""
+    try:
+        statm = open("/proc/self/statm")
+    except IOError:
+        return peakRSS()
+    try:
+        pages = int(statm.read().split()[1])
+    finally:
+        statm.close()
+    return pages * resource.getpagesize() // 1024
+
+def countNodes(node):
+    return sum(1 for x in node)
+
+def runStage(stage, document, scanBytes=False):
+    """Runs stage once over document and returns (tokens, nodes)."""
+    if stage == "inputstream":
+        # Read, decode and normalize every chunk without tokenizing, through
+        # the calls the data state of the tokenizer makes
+        if scanBytes:
+            stream = UTF8InputStream(document, None)
+        else:
+            stream = XMLInputStream(document, None)
+        while stream.char() is not EOF:
+            stream.charsUntil(inputStreamStop)
+        return None, None
+    elif stage == "tokenizer":
+        tokens = 0
+        for token in XMLTokenizer(document, scanBytes=scanBytes):
+            tokens += 1
+        return tokens, None
+    elif stage in ("tree", "memory"):
+        parser = XMLParser(scanBytes=scanBytes)
+        return None, countNodes(parser.parse(document))
+    raise ValueError("Unknown stage %r" % stage)
+
+def measure(case):
+    """Measures a single (corpus, size, stage, repeat, scanBytes) case.
+    This is run in a fresh worker process so the reported peak RSS belongs
+    to the case."""
+    corpus, size, stage, repeat, scanBytes = case
+    document = corpora[corpus](size)
+    if stage == "memory":
+        return measureMemory(corpus, size, document, scanBytes)
+    best = None
+    for i in xrange(repeat):
+        gc.collect()
+        start = time.time()
+        tokens, nodes = runStage(stage, document, scanBytes)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    if stage == "tree":
+        # Token counts are taken from a separate tokenizer pass so the tree
+        # stage can report tokens/s without timing the counting.
+        tokens = runStage("tokenizer", document, scanBytes)[0]
+    elapsed = max(best, 1e-9)
+    result = {
+      "corpus":corpus,
+      "size":size,
+      "bytes":len(document),
+      "stage":stage,
+      "scanBytes":scanBytes,
+      "seconds":best,
+      "mbPerSec":len(document) / elapsed / 1e6,
+      "tokens":tokens,
+      "tokensPerSec":tokens and tokens / elapsed,
+      "nodes":nodes,
+      "nodesPerSec":nodes and nodes / elapsed,
+      "peakRSS":peakRSS()
+    }
+    return result
+
+def measureMemory(corpus, size, document, scanBytes=False):
+    """Measures how much the resident set grows while a parsed document is
+    kept, which includes memory the parser freed but the process kept."""
+    gc.collect()
+    before = currentRSS()
+    tree = XMLParser(scanBytes=scanBytes).parse(document)
+    gc.collect()
+    after = currentRSS()
+    nodes = countNodes(tree)
+    return {
+      "corpus":corpus,
+      "size":size,
+      "bytes":len(document),
+      "stage":"memory",
+      "scanBytes":scanBytes,
+      "nodes":nodes,
+      "treeBytes":(after - before) * 1024,
+      "bytesPerNode":(after - before) * 1024.0 / max(nodes, 1),
+      "peakRSS":peakRSS()
+    }
+
+def gitRevision():
+    try:
+        import subprocess
+        process = subprocess.Popen(["git", "rev-parse", "HEAD"],
+          stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+          cwd=os.path.dirname(os.path.abspath(__file__)))
+        revision = process.communicate()[0].strip()
+        if process.returncode == 0:
+            return revision
+    except OSError:
+        pass
+    return None
+
+def runBenchmarks(corpusNames, sizes, repeat=3, isolate=True,
+  scanBytes=False, stageNames=stages):
+    """Runs the stages for every corpus and size and returns the report as
+    a dictionary. sizes are in bytes. With scanBytes the document is
+    scanned as UTF-8 bytes, see inputstream.UTF8InputStream."""
+    cases = []
+    for name in corpusNames:
+        if name not in corpora:
+            raise ValueError("Unknown corpus %r" % name)
+        for size in sizes:
+            for stage in stageNames:
+                if stage not in stages:
+                    raise ValueError("Unknown stage %r" % stage)
+                cases.append((name, size, stage, repeat, scanBytes))
+
+    if isolate:
+        import multiprocessing
+        pool = multiprocessing.Pool(1, maxtasksperchild=1)
+        try:
+            results = pool.map(measure, cases, 1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(measure, cases)
+
+    return {
+      "revision":gitRevision(),
+      "python":sys.version.split()[0],
+      "platform":sys.platform,
+      "timestamp":time.time(),
+      "repeat":repeat,
+      "results":results
+    }
+
+def main(argv=None):
+    import json
+    from optparse import OptionParser
+    optionParser = OptionParser(usage="%prog [options]")
+    optionParser.add_option("-c", "--corpora",
+      default=",".join(sorted(corpora)),
+      help="comma separated corpora to run [%default]")
+    optionParser.add_option("-s", "--sizes", default="16,128,1024",
+      help="comma separated document sizes in KB [%default]")
+    optionParser.add_option("-t", "--stages", default=",".join(stages),
+      help="comma separated stages to run [%default]")
+    optionParser.add_option("-r", "--repeat", type="int", default=3,
+      help="runs per case, the fastest is reported [%default]")
+    optionParser.add_option("-o", "--output",
+      help="write the JSON report to this file instead of stdout")
+    optionParser.add_option("--no-isolate", dest="isolate", default=True,
+      action="store_false",
+      help="run every case in this process; peak RSS is then cumulative")
+    optionParser.add_option("--scan-bytes", dest="scanBytes", default=False,
+      action="store_true",
+      help="scan the documents as UTF-8 bytes instead of decoding them")
+    options, args = optionParser.parse_args(argv)
+
+    sizes = [int(size) * 1024 for size in options.sizes.split(",")]
+    report = runBenchmarks(options.corpora.split(","), sizes,
+      options.repeat, options.isolate, options.scanBytes,
+      options.stages.split(","))
+
+    if options.output:
+        out = open(options.output, "w")
+    else:
+        out = sys.stdout
+    json.dump(report, out, indent=1, sort_keys=True)
+    out.write("\n")
+    if options.output:
+        out.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+"""A cache of parsed documents for services that parse the same documents
+over and over.
+
+  cache = ParseCache(maxBytes=32 << 20, directory="/var/cache/xml5")
+  document = cache.parse(open("config.xml").read())
+
+Documents are keyed by a hash of their bytes, the encoding they were parsed
+with, the tree builder, the entity limits and the DTD catalog. The cache
+keeps a compact form of each tree, a flat marshalled list of tuples, and
+builds a new document from it on every hit, so callers can change the
+documents they get without affecting the cache or each other. The
+in-memory tier drops the least recently used trees once their size
+exceeds maxBytes. With a directory the trees are also written there and
+read back when they are no longer in memory.
+
+The files are read back with marshal, which is not safe against data made
+to attack it. The directory must only be writable by the owner of the
+process; it is created with mode 0700 if it doesn't exist. Each file starts
+with a header naming the format and the interpreter, and a SHA-1 of the
+tree, so files that are damaged or written by another build are ignored.
+"""
+import hashlib
+import marshal
+import os
+import sys
+import tempfile
+
+from collections import OrderedDict
+
+import serializer
+from dtd import dtds
+from entities import EntityLimits
+from parser import XMLParser
+from symbols import symbols
+from treebuilders import simpletree
+from treebuilders._base import Attribute
+
+# Bumped whenever the compact form changes, so files written in an older
+# form are never read
+formatVersion = 1
+
+# The start of every file in a cache directory. The marshal format can
+# change between builds of the interpreter, so the header names the build;
+# the SHA-1 of the tree follows it.
+fileHeader = "xml5 tree %d %d %s\n" % (formatVersion, marshal.version,
+  hashlib.sha1(sys.version).hexdigest())
+
+def compactTree(document):
+    """Returns the nodes of document as a flat list of tuples in document
+    order. Elements carry the number of children that follow them:
+
+      (ELEMENT_NODE, name, prefix, localname, namespace, attributes, span,
+        children)
+      (TEXT_NODE, value, span)
+      (COMMENT_NODE, data, span)
+      (PROCESSING_INSTRUCTION_NODE, name, data, span)
+
+    where attributes is a tuple of (name, localname, prefix, namespace,
+    value) tuples or None. The list starts with the number of children of
+    the document."""
+    records = [len(document.childNodes)]
+    for node in document:
+        nodeType = node.nodeType
+        if nodeType == serializer.ELEMENT_NODE:
+            attributes = node.attributes
+            if attributes:
+                attributes = tuple([(attribute.name, attribute.localname,
+                  attribute.prefix, attribute.namespace, attribute.value)
+                  for attribute in attributes])
+            records.append((nodeType, node.name, node.prefix, node.localname,
+              node.namespace, attributes, node.span, len(node.childNodes)))
+        elif nodeType == serializer.TEXT_NODE:
+            records.append((nodeType, node.value, node.span))
+        elif nodeType == serializer.COMMENT_NODE:
+            records.append((nodeType, node.data, node.span))
+        elif nodeType == serializer.PROCESSING_INSTRUCTION_NODE:
+            records.append((nodeType, node.name, node.data, node.span))
+        else:
+            raise TypeError("Can't cache %r" % node)
+    return records
+
+def buildTree(records, builder):
+    """Builds a new document from the records of compactTree() with the
+    classes of builder, a simpletree TreeBuilder."""
+    builder.reset()
+    document = builder.document
+    index = document.index
+    intern = symbols.intern
+    # The nodes that still get children and how many
+    parent = document
+    remaining = records[0]
+    stack = []
+    for record in records[1:]:
+        while not remaining:
+            parent, remaining = stack.pop()
+        nodeType = record[0]
+        if nodeType == serializer.ELEMENT_NODE:
+            (nodeType, name, prefix, localname, namespace, attributes, span,
+              children) = record
+            if attributes:
+                attributes = [Attribute(intern(a[0]), intern(a[1]),
+                  intern(a[2]), intern(a[3]), a[4]) for a in attributes]
+            node = builder.elementClass(intern(name), intern(prefix),
+              intern(localname), intern(namespace), attributes)
+            if index is not None:
+                index.add(node)
+        elif nodeType == serializer.TEXT_NODE:
+            node = simpletree.Text(record[1])
+        elif nodeType == serializer.COMMENT_NODE:
+            node = builder.commentClass(record[1])
+        else:
+            node = builder.piClass(record[1], record[2])
+        node.span = record[-1]
+        # Not appendChild(), which would merge adjacent text
+        parent.childNodes.append(node)
+        node.parent = parent
+        remaining -= 1
+        if nodeType == serializer.ELEMENT_NODE and children:
+            stack.append((parent, remaining))
+            parent = node
+            remaining = children
+    return document
+
+class ParseCache(object):
+    """Parses documents through an LRU cache of their trees.
+
+    maxBytes bounds the size of the compact trees kept in memory. If
+    directory is given trees are also kept there, one file per document.
+    It must be private to the owner of the process, see above.
+    Documents are parsed with entityLimits and dtdCache as XMLParser takes
+    them. hits, misses, diskHits and evictions count what the cache did;
+    diskHits are counted among the misses of the in-memory tier.
+    """
+
+    def __init__(self, maxBytes=32 << 20, directory=None, entityLimits=None,
+      dtdCache=dtds):
+        self.maxBytes = maxBytes
+        self.directory = directory
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory, 0700)
+        self.entityLimits = entityLimits
+        self.dtdCache = dtdCache
+        self.trees = OrderedDict()
+        self.size = 0
+        self.hits = self.misses = self.diskHits = self.evictions = 0
+
+    def key(self, data, encoding, tree):
+        limits = self.entityLimits or EntityLimits()
+        digest = hashlib.sha1()
+        digest.update("%d %d %s.%s %s\0" % (formatVersion, marshal.version,
+          tree.__module__, tree.__name__, encoding or ""))
+        # The same bytes can give another tree under other limits or with
+        # other DTDs in the catalog
+        digest.update("%r %r %r %r %r %r\0" % (limits.maxCharacters,
+          limits.maxDepth, limits.maxRatio, limits.ratioThreshold,
+          limits.maxParameterEntities, limits.policy))
+        if self.dtdCache is not None:
+            digest.update(self.dtdCache.catalogKey())
+        digest.update("\0")
+        digest.update(data)
+        return digest.hexdigest()
+
+    def parse(self, source, encoding=None, tree=simpletree.TreeBuilder):
+        """Returns a new document parsed from source, a string of bytes or a
+        file object, with XMLParser(tree=tree). tree must build simpletree
+        nodes."""
+        if hasattr(source, "read"):
+            source = source.read()
+        key = self.key(source, encoding, tree)
+        data = self.trees.pop(key, None)
+        if data is not None:
+            self.hits += 1
+            self.trees[key] = data
+            return buildTree(marshal.loads(data), tree())
+        self.misses += 1
+        data = self.read(key)
+        if data is not None:
+            self.diskHits += 1
+            self.store(key, data)
+            return buildTree(marshal.loads(data), tree())
+        document = XMLParser(tree=tree, entityLimits=self.entityLimits,
+          dtdCache=self.dtdCache).parse(source, encoding)
+        data = marshal.dumps(compactTree(document))
+        self.store(key, data)
+        self.write(key, data)
+        return document
+
+    def store(self, key, data):
+        """Keeps data in memory as the most recently used tree, dropping the
+        least recently used ones while the cache is too large."""
+        if len(data) > self.maxBytes:
+            return
+        self.trees[key] = data
+        self.size += len(data)
+        while self.size > self.maxBytes:
+            key, data = self.trees.popitem(last=False)
+            self.size -= len(data)
+            self.evictions += 1
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".tree")
+
+    def read(self, key):
+        """Returns the tree in the file for key, or None if there is none.
+        A file with another header or checksum is deleted."""
+        if self.directory is None:
+            return None
+        try:
+            f = open(self.path(key), "rb")
+        except IOError:
+            return None
+        try:
+            contents = f.read()
+        finally:
+            f.close()
+        start = len(fileHeader) + 20
+        data = contents[start:]
+        if not contents.startswith(fileHeader) or\
+          contents[len(fileHeader):start] != hashlib.sha1(data).digest():
+            self.remove(key)
+            return None
+        return data
+
+    def remove(self, key):
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
+
+    def write(self, key, data):
+        # Written to a temporary file first so other processes sharing the
+        # directory never read half a tree
+        if self.directory is None:
+            return
+        fd, temporary = tempfile.mkstemp(".tmp", "", self.directory)
+        f = os.fdopen(fd, "wb")
+        try:
+            try:
+                f.write(fileHeader)
+                f.write(hashlib.sha1(data).digest())
+                f.write(data)
+            finally:
+                f.close()
+            os.rename(temporary, self.path(key))
+        except EnvironmentError:
+            os.remove(temporary)
+            raise
+
+    def clear(self):
+        """Empties the in-memory tier. Files in the directory are kept."""
+        self.trees.clear()
+        self.size = 0
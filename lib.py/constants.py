@@ -12,3 +12,18 @@ spaceCharacters = frozenset((
 ))
 digits = frozenset(string.digits)
 hexDigits = frozenset(string.hexdigits)
+
+# The kinds of token the tokenizer emits
+tokenTypes = {
+    "Characters":0,
+    "StartTag":1,
+    "EmptyTag":2,
+    "EndTag":3,
+    "EndTagShort":4,
+    "Comment":5,
+    "Pi":6
+}
+tokenTypeNames = dict([(value, key) for key, value in tokenTypes.items()])
+
+tagTokenTypes = frozenset((tokenTypes["StartTag"], tokenTypes["EmptyTag"],
+    tokenTypes["EndTag"]))
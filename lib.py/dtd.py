@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+"""Compiled DTDs, so documents that share a DTD don't parse it again.
+
+The tokenizer builds a DTD out of the declarations in an internal subset:
+the entities, the parameter entities and the ATTLIST declarations. A
+DTDCache keeps them by a hash of the text of the subset. When another
+document has a subset with the same text its DTD is taken from the cache
+and the subset is skipped. Only subsets that end at their first "]" are
+cached, which is all of them unless a literal or comment has one.
+
+A cache can also hold DTD files from a local catalog, compiled once and
+looked up by the system identifier of a DOCTYPE. Identifiers are matched in
+full, so the files are added under the identifiers documents use:
+
+  dtds.loadCatalog("/usr/share/xml/xhtml", "http://www.w3.org/TR/xhtml1/DTD/")
+
+Compiled DTDs are shared between documents and must not be changed.
+"""
+import hashlib
+import os
+
+from collections import OrderedDict
+from itertools import islice
+
+def attributeDefaults(attributeNormalization, start=0, defaults=None):
+    """Returns the default attributes of the ATTLIST declarations in
+    attributeNormalization as a dict of element names to tuples of (name,
+    value) pairs. Where an attribute is declared more than once the first
+    declaration applies.
+
+    defaults can be the result for the first start declarations, so only
+    the ones after those are compiled. It is copied, not changed."""
+    if defaults is None:
+        defaults = {}
+    else:
+        defaults = dict(defaults)
+    for declaration in islice(attributeNormalization, start, None):
+        element = declaration["name"]
+        attributes = defaults.get(element, ())
+        declared = set([name for name, value in attributes])
+        added = [(attribute["name"], attribute["dv"])
+          for attribute in declaration["attrs"] if attribute["dv"] != ""]
+        for name, value in added:
+            if name not in declared:
+                declared.add(name)
+                attributes += ((name, value),)
+        if attributes:
+            defaults[element] = attributes
+    return defaults
+
+class DTD(object):
+    """The declarations of a DTD. entities and parameterEntities map names
+    to values; attributeNormalization lists the ATTLIST declarations as the
+    tokenizer keeps them and attributeDefaults has them compiled by
+    attributeDefaults().
+
+    expandedParameterEntities, characters and depth are what expanding
+    parameter entities took while the DTD was parsed, so the entity limits
+    of a document that uses it can still be applied. size is the number of
+    characters in its declarations, which a DTDCache counts.
+    """
+    __slots__ = ("entities", "parameterEntities", "attributeNormalization",
+      "attributeDefaults", "expandedParameterEntities", "characters", "depth",
+      "size")
+
+    def __init__(self, entities, parameterEntities, attributeNormalization,
+      expandedParameterEntities=0, characters=0, depth=0):
+        self.entities = entities
+        self.parameterEntities = parameterEntities
+        self.attributeNormalization = attributeNormalization
+        self.attributeDefaults = attributeDefaults(attributeNormalization)
+        self.expandedParameterEntities = expandedParameterEntities
+        self.characters = characters
+        self.depth = depth
+        size = 0
+        for table in (entities, parameterEntities):
+            for name, value in table.iteritems():
+                size += len(name) + len(value)
+        for declaration in attributeNormalization:
+            size += len(declaration["name"])
+            for attribute in declaration["attrs"]:
+                size += len(attribute["name"]) + len(attribute["type"]) +\
+                  len(attribute["dv"])
+        self.size = size
+
+def compileDTD(text):
+    """Returns the DTD declared by text, the contents of a DTD file."""
+    from tokenizer import XMLTokenizer
+    tokenizer = XMLTokenizer(text, dtdCache=None)
+    states = tokenizer.states
+    ends = (states["data"], states["doctypeInternalSubsetAfter"])
+    tokenizer.stream.reset()
+    tokenizer.state = states["doctypeInternalSubset"]
+    while tokenizer.state() and tokenizer.state not in ends:
+        pass
+    stats = tokenizer.entityStats
+    return DTD(tokenizer.entities, tokenizer.parameterEntities,
+      tokenizer.attributeNormalization, stats.parameterEntities,
+      stats.characters, stats.depth)
+
+class DTDCache(object):
+    def __init__(self, maxSize=1000, maxCharacters=4 << 20,
+      maxSubsetLength=1 << 20):
+        """maxSize bounds the number of internal subsets kept and
+        maxCharacters the total size of their DTDs, so documents with
+        endless distinct subsets can't grow the cache forever. Past either
+        the least recently used subsets are dropped. Longer subsets than
+        maxSubsetLength are not looked for."""
+        self.maxSize = maxSize
+        self.maxCharacters = maxCharacters
+        self.maxSubsetLength = maxSubsetLength
+        self.subsets = OrderedDict()
+        self.size = 0
+        self.evictions = 0
+        self.catalog = {}
+        # The SHA-1 of each file in the catalog, for catalogKey()
+        self.digests = {}
+        # File names that match any identifier ending in them, and the
+        # identifier in the catalog each stands for
+        self.names = {}
+
+    def key(self, text):
+        """Returns the key of the internal subset text, which is either
+        unicode or UTF-8."""
+        if isinstance(text, unicode):
+            text = text.encode("utf-8")
+        return hashlib.sha1(text).digest()
+
+    def get(self, key):
+        dtd = self.subsets.pop(key, None)
+        if dtd is not None:
+            self.subsets[key] = dtd
+        return dtd
+
+    def add(self, key, dtd):
+        """Keeps dtd as the most recently used subset, dropping the least
+        recently used ones while the cache is too large."""
+        if dtd.size > self.maxCharacters:
+            return
+        previous = self.subsets.pop(key, None)
+        if previous is not None:
+            self.size -= previous.size
+        self.subsets[key] = dtd
+        self.size += dtd.size
+        while len(self.subsets) > self.maxSize or\
+          self.size > self.maxCharacters:
+            key, dtd = self.subsets.popitem(last=False)
+            self.size -= dtd.size
+            self.evictions += 1
+
+    def addFile(self, identifier, path, matchName=False):
+        """Compiles the DTD file at path and adds it to the catalog as
+        identifier. With matchName it is also used for any system
+        identifier whose last path segment is the file name, wherever it
+        points; only use that for names that are unambiguous."""
+        f = open(path, "rb")
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        self.catalog[identifier] = compileDTD(data)
+        self.digests[identifier] = hashlib.sha1(data).hexdigest()
+        if matchName:
+            self.names[os.path.basename(path)] = identifier
+
+    def loadCatalog(self, directory, base="", matchName=False):
+        """Adds every .dtd file in directory to the catalog as base
+        followed by its file name. matchName is passed to addFile()."""
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(".dtd"):
+                self.addFile(base + name, os.path.join(directory, name),
+                  matchName)
+
+    def catalogKey(self):
+        """Returns a digest of the identifiers and files in the catalog,
+        which changes whenever a file is added, replaced or removed."""
+        digest = hashlib.sha1()
+        for identifier in sorted(self.catalog):
+            digest.update("%r %s\0" % (identifier,
+              self.digests.get(identifier, "")))
+        for name in sorted(self.names):
+            digest.update("%r %r\0" % (name, self.names[name]))
+        return digest.hexdigest()
+
+    def lookup(self, identifier):
+        """Returns the DTD in the catalog for a system identifier, or None.
+        The identifier has to match in full unless the last segment of its
+        path is the name of a file added with matchName."""
+        dtd = self.catalog.get(identifier)
+        if dtd is None:
+            name = identifier.rstrip("/").rsplit("/", 1)[-1]
+            if name in self.names:
+                dtd = self.catalog.get(self.names[name])
+        return dtd
+
+# The cache shared by all parses in the process
+dtds = DTDCache()
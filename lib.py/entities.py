@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+"""The replacement text of general entities, worked out once per entity.
+
+A reference is expanded by pushing the entity's value back in front of the
+stream so markup in it is tokenized like any other input. Most values are
+plain text though, perhaps with character references such as the one that
+&lt; stands for, and those can be added to the current text or attribute
+value directly. Replacement keeps both: the text to push back and, where
+the value has no markup, the text it would have been tokenized into.
+"""
+import re
+
+# Character references that are resolved the same way no matter where the
+# value is used
+characterReferenceRegEx = re.compile(u"&#(?:x([0-9a-fA-F]+)|([0-9]+));")
+
+# A value of text and character references only
+plainTextRegEx = re.compile(u"(?:[^&<]|&#(?:x[0-9a-fA-F]+|[0-9]+);)*\\Z")
+
+# Characters that would end or change an attribute value if they were
+# tokenized as they are, and the references they are pushed back as
+attributeEscapes = {
+  u"\n":u"&#10;",
+  u"\r":u"&#10;",
+  u"\t":u"&#9;",
+  u" ":u"&#32;",
+  u"\"":u"&#34;",
+  u"'":u"&#39;"
+}
+attributeEscapeRegEx = re.compile(u"[\n\r\t \"']")
+
+# Characters that end an unquoted attribute value and aren't escaped
+unquotedStopRegEx = re.compile(u"[>\u000B\u000C]")
+
+def resolveCharacterReference(match):
+    # The same conversion as XMLTokenizer.consumeNumberEntity
+    if match.group(1) is not None:
+        charAsInt = int(match.group(1), 16)
+    else:
+        charAsInt = int(match.group(2))
+    if charAsInt == 0:
+        charAsInt = 65533
+    try:
+        return unichr(charAsInt)
+    except (ValueError, OverflowError):
+        return u"\uFFFD"
+
+class Replacement(object):
+    """The forms of an entity value.
+
+      content        the value, pushed back when referenced in content
+      attribute      the value with white space and quotes escaped, pushed
+                     back when referenced in an attribute value
+      text           what content tokenizes into if it is character data
+                     only, otherwise None
+      attributeText  the same for attribute values
+      unquotedText   the same for unquoted attribute values
+    """
+    __slots__ = ("content", "attribute", "text", "attributeText",
+      "unquotedText")
+
+    def __init__(self, value):
+        self.content = value
+        self.attribute = attributeEscapeRegEx.sub(
+          lambda match: attributeEscapes[match.group(0)], value)
+        self.text = self.attributeText = self.unquotedText = None
+        if value and plainTextRegEx.match(value) is not None:
+            self.text = characterReferenceRegEx.sub(
+              resolveCharacterReference, value)
+            # A literal "\r" is escaped as a new line
+            self.attributeText = characterReferenceRegEx.sub(
+              resolveCharacterReference, value.replace(u"\r", u"\n"))
+            if unquotedStopRegEx.search(
+              characterReferenceRegEx.sub(u"", value)) is None:
+                self.unquotedText = self.attributeText
+
+class EntityLimitExceeded(Exception):
+    """Raised when a document expands entities past one of the limits of
+    its EntityLimits and the policy is "abort". limit is the name of the
+    limit, stats the EntityStats of the parse so far."""
+
+    def __init__(self, limit, stats):
+        Exception.__init__(self, "entity expansion exceeds %s" % limit)
+        self.limit = limit
+        self.stats = stats
+
+class EntityLimits(object):
+    """Bounds on the entity expansion of a single parse.
+
+      maxCharacters         characters of replacement text expanded in
+                            total, nested expansions included
+      maxDepth              how deeply expansions may be nested
+      maxRatio              characters expanded per character of the
+                            document read so far, only checked once more
+                            than ratioThreshold characters were expanded
+      maxParameterEntities  parameter entities expanded in the internal
+                            subset
+
+    The defaults stop a small document from expanding into more than a
+    few tens of thousands of characters, and any document from expanding
+    into more than a million; documents that legitimately expand more need
+    higher limits. None disables a limit. When a reference would exceed a
+    limit the policy decides what happens: "truncate" drops the reference
+    and parsing goes on, "abort" raises EntityLimitExceeded.
+    """
+
+    def __init__(self, maxCharacters=1000000, maxDepth=16, maxRatio=100,
+      ratioThreshold=65536, maxParameterEntities=10000, policy="truncate"):
+        if policy not in ("abort", "truncate"):
+            raise ValueError("Unknown policy %r" % policy)
+        self.maxCharacters = maxCharacters
+        self.maxDepth = maxDepth
+        self.maxRatio = maxRatio
+        self.ratioThreshold = ratioThreshold
+        self.maxParameterEntities = maxParameterEntities
+        self.policy = policy
+
+class EntityStats(object):
+    """What a parse expanded: the number of entities and parameter
+    entities, the characters of replacement text, the deepest nesting and
+    the number of references that were dropped for exceeding a limit."""
+    __slots__ = ("entities", "parameterEntities", "characters", "depth",
+      "dropped")
+
+    def __init__(self):
+        self.entities = self.parameterEntities = self.characters = 0
+        self.depth = self.dropped = 0
+
+    def save(self):
+        return (self.entities, self.parameterEntities, self.characters,
+          self.depth, self.dropped)
+
+    def restore(self, saved):
+        (self.entities, self.parameterEntities, self.characters,
+          self.depth, self.dropped) = saved
+
+    def __repr__(self):
+        return ("<EntityStats entities=%d parameterEntities=%d "
+          "characters=%d depth=%d dropped=%d>" % self.save())
@@ -1,44 +1,115 @@
 #!/usr/bin/env python
 import codecs
+import mmap
 import re
+from array import array
+from bisect import bisect_left
 EOF = None
 
+# Cache of the regular expressions used by charsUntil, keyed by the
+# (characters, opposite) arguments.
+charsUntilRegEx = {}
+
+# How "<?xml" starts in encodings that can't be read as ASCII, for documents
+# without a BOM.
+declarationPrefixes = (
+    ("<\x00\x00\x00", "utf-32-le"), ("\x00\x00\x00<", "utf-32-be"),
+    ("<\x00?\x00", "utf-16-le"), ("\x00<\x00?", "utf-16-be")
+)
+# The line breaks that are normalized to "\n", and NUL characters
+newLineRegEx = re.compile("\r\n?")
+nulRegEx = re.compile("\x00")
+
+encodingDeclarationRegEx = re.compile(
+    r"""<\?xml[^>]*?\sencoding\s*=\s*(["'])([A-Za-z][A-Za-z0-9._\-]*)\1""")
+
+def mapFile(path):
+    """Returns a read-only memory map of the file at path, which can be read
+    like a file object. The pages are read from the page cache as they are
+    needed, and shared with other processes mapping the same file. Files
+    that can't be mapped, such as empty files and pipes, are returned
+    opened instead."""
+    f = open(path, "rb")
+    try:
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, EnvironmentError):
+        return f
+    # The map keeps a descriptor of its own
+    f.close()
+    return mapping
+
+class NeedData(Exception):
+    """Raised when a stream that is being fed has no more characters but
+    has not been closed yet."""
+    pass
+
 class XMLInputStream(object):
-    def __init__(self, source, tokenizer, encoding=None):
-        """XMLInputStream(source, tokenizer, [encoding])
+    # Number of bytes read from the octet stream at a time
+    chunkSize = 65536
 
-        source can be either a file-object, local filename or a string.
+    # What NUL characters are replaced with
+    replacementCharacter = u"\uFFFD"
+
+    def __init__(self, source, tokenizer, encoding=None,
+      trackPositions=False):
+        """XMLInputStream(source, tokenizer, [encoding, trackPositions])
+
+        source can be either a file-object, local filename or a string. If
+        source is None the document is passed in chunks to feed() instead
+        and close() is called after the last one.
+
+        With trackPositions the offset of every new line is recorded as the
+        document is read so location() works for any offset, not just the
+        current one.
         """
 
-        # List of where new lines occur
-        self.newLines = []
-        
+        # Offsets of the new lines in the document, only kept when
+        # trackPositions is set. Without it only the number of new lines
+        # in the characters that were dropped and where the last of those
+        # lines started are kept.
+        self.trackPositions = trackPositions
+        self.newLines = array("l")
+        self.droppedLines = 0
+        self.droppedLineStart = 0
+
         # Need a reference to the tokenizer object to deal with the madness
         # that is XML entities
         self.tokenizer = tokenizer
 
-        # The octet stream
-        self.rawStream = self.openStream(source)
-
         self.defaultEncoding = "UTF-8"
 
-        # Detect encoding if no explicit "transport level" encoding is
-        # supplied
-        if not encoding:
-            encoding = self.detectEncoding()
-        self.charEncoding = encoding
+        # Text pushed back in front of the data stream, most recent last.
+        # Each frame is a [text, offset, depth] list where offset is the
+        # position of the next character to read from text and depth the
+        # number of entity expansions the text is nested in. Entity
+        # replacement text is pushed as a single frame and characters that
+        # were read too far are put back by moving an offset back where
+        # possible.
+        self.frames = []
 
-        # The Unicode string
-        uString = self.rawStream.read().decode(self.charEncoding, 'replace')
+        # Number of characters dropped from the start of the data stream
+        # and the position of the last mark, both counted from the start of
+        # the document.
+        self.offset = 0
+        self.markOffset = 0
 
-        # Normalize newlines and null characters
-        uString = re.sub('\r\n?', '\n', uString)
-        uString = re.sub('\x00', u'\uFFFD', uString)
+        # The octet stream, None when the document is fed in
+        if source is None:
+            self.rawStream = None
+        else:
+            self.rawStream = self.openStream(source)
 
-        # Convert the unicode string into a list to be used as the data stream
-        self.dataStream = uString
+        # The encoding is detected from the first bytes of the document if
+        # no explicit "transport level" encoding is supplied
+        self.charEncoding = encoding
+        self.decoder = None
+        self.pendingBytes = ""
+        self.pendingCR = False
 
-        self.queue = []
+        # The decoded and normalized characters that have not been read yet,
+        # and possibly some that have. It is refilled a chunk at a time.
+        self.dataStream = u""
+        self.closed = False
 
         # Reset position in the list to read from
         self.reset()
@@ -57,17 +128,19 @@ class XMLInputStream(object):
             stream = cStringIO.StringIO(str(source))
         return stream
 
-    def detectEncoding(self):
-        # XXX This doesn't cover <?xml encoding=""?>
-        encoding = self.detectBOM()
+    def detectEncoding(self, string):
+        """Returns (encoding, length of the BOM) for a document starting
+        with string. The encoding is taken from the BOM or else the XML
+        declaration and is None if neither gives one."""
+        encoding, seek = self.detectBOM(string)
         if encoding is None:
-            encoding = self.defaultEncoding
-        return encoding
+            encoding = self.detectEncodingDeclaration(string)
+        return encoding, seek
 
-    def detectBOM(self):
-        """Attempts to detect at BOM at the start of the stream. If
-        an encoding can be determined from the BOM return the name of the
-        encoding otherwise return None"""
+    def detectBOM(self, string):
+        """Attempts to detect at BOM at the start of string. If an encoding
+        can be determined from the BOM return the name of the encoding and
+        the length of the BOM, otherwise return (None, 0)"""
 
         bomDict = {
             codecs.BOM_UTF8: 'utf-8',
@@ -75,10 +148,6 @@ class XMLInputStream(object):
             codecs.BOM_UTF32_LE: 'utf-32-le', codecs.BOM_UTF32_BE: 'utf-32-be'
         }
 
-        # Go to beginning of file and read in 4 bytes
-        self.rawStream.seek(0)
-        string = self.rawStream.read(4)
-
         # Try detecting the BOM using bytes from the string
         encoding = bomDict.get(string[:3])       # UTF-8
         seek = 3
@@ -86,84 +155,409 @@ class XMLInputStream(object):
             encoding = bomDict.get(string[:2])   # UTF-16
             seek = 2
             if not encoding:
-                encoding = bomDict.get(string)   # UTF-32
+                encoding = bomDict.get(string[:4])   # UTF-32
                 seek = 4
+        if not encoding:
+            seek = 0
+        return encoding, seek
 
-        # Set the read position past the BOM if one was found, otherwise
-        # set it to the start of the stream
-        self.rawStream.seek(encoding and seek or 0)
-
+    def detectEncodingDeclaration(self, string):
+        """Returns the encoding of a document without a BOM from the way
+        "<?xml" is encoded and the encoding pseudo-attribute of the XML
+        declaration, or None."""
+        for prefix, encoding in declarationPrefixes:
+            if string.startswith(prefix):
+                return encoding
+        match = encodingDeclarationRegEx.match(string)
+        if not match:
+            return None
+        try:
+            encoding = codecs.lookup(match.group(2)).name
+        except LookupError:
+            # XXX parse error
+            return None
+        if encoding.startswith("utf-16") or encoding.startswith("utf-32"):
+            # The declaration was readable as ASCII so it can't be right
+            return None
         return encoding
 
-    def determineNewLines(self):
-        # Looks through the stream to find where new lines occur so
-        # the position method can tell where it is.
-        self.newLines.append(0)
-        for i in xrange(len(self.dataStream)):
-            if self.dataStream[i] == u"\n":
-                self.newLines.append(i)
+    def getDecoder(self, encoding):
+        """Returns the incremental decoder that turns the octet stream into
+        the characters kept in dataStream."""
+        return codecs.getincrementaldecoder(encoding)('replace')
+
+    def feed(self, data):
+        """Appends the next chunk of bytes of the document. Characters that
+        were read before the most recent mark are dropped."""
+        assert not self.closed
+        self.appendBytes(data, False)
+
+    def close(self):
+        """Marks the end of the document after the last feed."""
+        if not self.closed:
+            self.appendBytes("", True)
+            self.closed = True
+
+    def readChunk(self):
+        """Reads the next chunk of the octet stream and appends it, dropping
+        the characters that have been read."""
+        data = self.rawStream.read(self.chunkSize)
+        self.markOffset = self.offset + self.tell
+        if data:
+            self.appendBytes(data, False)
+        else:
+            self.appendBytes("", True)
+            self.closed = True
+
+    def appendBytes(self, data, final):
+        if self.decoder is None:
+            # Hold back the first bytes until there are enough to look for a
+            # BOM or the end of the XML declaration.
+            data = self.pendingBytes + data
+            if not self.charEncoding and not final and (len(data) < 4 or
+              data.startswith("<?xm") and data.find(">") == -1 and
+              len(data) < 1024):
+                self.pendingBytes = data
+                return
+            self.pendingBytes = ""
+            if not self.charEncoding:
+                encoding, seek = self.detectEncoding(data)
+                data = data[seek:]
+                self.charEncoding = encoding or self.defaultEncoding
+            self.decoder = self.getDecoder(self.charEncoding)
+
+        uString = self.decoder.decode(data, final)
+
+        # A "\r" at the end of a chunk may be followed by a "\n" at the start
+        # of the next so it is normalized together with the next chunk. The
+        # literals are byte strings so they go with the bytes UTF8InputStream
+        # keeps as well.
+        if self.pendingCR:
+            uString = "\r" + uString
+            self.pendingCR = False
+        if not final and uString.endswith("\r"):
+            uString = uString[:-1]
+            self.pendingCR = True
+
+        # Normalize newlines and null characters. A chunk without either
+        # is only scanned, not copied.
+        uString = newLineRegEx.sub("\n", uString)
+        uString = nulRegEx.sub(self.replacementCharacter, uString)
+
+        discard = self.markOffset - self.offset
+        if discard > 0:
+            if not self.trackPositions:
+                dropped = self.dataStream.count("\n", 0, discard)
+                if dropped:
+                    self.droppedLines += dropped
+                    self.droppedLineStart = self.offset + \
+                      self.dataStream.rfind("\n", 0, discard) + 1
+            self.dataStream = self.dataStream[discard:]
+            self.tell -= discard
+            self.offset += discard
+        if self.trackPositions:
+            start = self.offset + len(self.dataStream)
+            newLines = self.newLines
+            i = uString.find("\n")
+            while i != -1:
+                newLines.append(start + i)
+                i = uString.find("\n", i + 1)
+        self.dataStream += uString
+
+    def mark(self):
+        """Returns the current position in the stream for rewind(). In feed
+        mode anything before the most recent mark may be dropped."""
+        self.markOffset = self.offset + self.tell
+        return self.markOffset, [list(frame) for frame in self.frames]
+
+    def rewind(self, mark):
+        """Goes back to a position returned by mark()."""
+        offset, frames = mark
+        self.tell = offset - self.offset
+        self.frames = [list(frame) for frame in frames]
+
+    def location(self, offset=None):
+        """Returns (line, col, offset) for offset, the number of characters
+        from the start of the document after new lines are normalized, or
+        for the current position if offset is None. Lines are counted from
+        1 and columns from 0. Other offsets than the current one need
+        trackPositions."""
+        if offset is None:
+            offset = self.offset + self.tell
+        if self.trackPositions:
+            newLines = self.newLines
+            line = bisect_left(newLines, offset)
+            if line:
+                lineStart = newLines[line - 1] + 1
+            else:
+                lineStart = 0
+        else:
+            tell = offset - self.offset
+            if tell != self.tell:
+                raise ValueError("offset %d needs trackPositions" % offset)
+            line = self.droppedLines + self.dataStream.count("\n", 0, tell)
+            lineStart = self.dataStream.rfind("\n", 0, tell)
+            if lineStart == -1:
+                lineStart = self.droppedLineStart
+            else:
+                lineStart += self.offset + 1
+        return (line + 1, offset - lineStart, offset)
 
     def position(self):
         """Returns (line, col) of the current position in the stream."""
-        # Generate list of new lines first time around
-        if not self.newLines:
-            self.determineNewLines()
-
-        line = 0
-        tell = self.tell
-        for pos in self.newLines:
-            if pos < tell:
-                line += 1
-            else:
-                break
-        col = tell - self.newLines[line-1] - 1
-        return (line, col)
+        return self.location()[:2]
 
     def reset(self):
         """Resets the position in the stream back to the start."""
         self.tell = 0
 
     def char(self):
-        """Read one character from the stream or queue if available. Return
-        EOF when EOF is reached.
+        """Read one character from the pushed back frames or the stream.
+        Return EOF when EOF is reached.
         """
-        if self.tokenizer.entityCount > 0:
-            self.tokenizer.charCount += 1
-            if self.tokenizer.charCount > self.tokenizer.entityValueLen:
-                self.tokenizer.entityValueLen = 0
-                self.tokenizer.charCount = 0
-                self.tokenizer.entityCount = 0
-        
-        if self.queue:
-            return self.queue.pop(0)
-        else:
-            try:
+        frames = self.frames
+        while frames:
+            frame = frames[-1]
+            offset = frame[1]
+            if offset < len(frame[0]):
+                frame[1] = offset + 1
+                return frame[0][offset]
+            frames.pop()
+
+        if self.tell < len(self.dataStream):
+            self.tell += 1
+            return self.dataStream[self.tell - 1]
+        while not self.closed:
+            if self.rawStream is None:
+                raise NeedData
+            self.readChunk()
+            if self.tell < len(self.dataStream):
                 self.tell += 1
                 return self.dataStream[self.tell - 1]
-            except:
-                return EOF
+        return EOF
+
+    def unget(self, c):
+        """Put c back in front of the stream so it is read again next. c is
+        normally the character that was just read, in which case this only
+        moves an offset back.
+        """
+        if c is EOF:
+            # Nothing can come after EOF so reading again gives EOF anyway.
+            return
+        frames = self.frames
+        if frames:
+            frame = frames[-1]
+            offset = frame[1]
+            if offset and frame[0][offset - 1] == c:
+                frame[1] = offset - 1
+                return
+            frames.append([c, 0, frame[2]])
+        elif self.tell and self.dataStream[self.tell - 1] == c:
+            self.tell -= 1
+        else:
+            frames.append([c, 0, 0])
+
+    def push(self, text, depth=0):
+        """Insert text in front of the stream, e.g. the replacement text of
+        an entity, so it is read before anything else. depth is the number
+        of entity expansions text is nested in."""
+        if text:
+            self.frames.append([text, 0, depth])
+
+    def depth(self):
+        """Returns the depth of the frame the last character was read from,
+        or 0 if it came from the document itself."""
+        if self.frames:
+            return self.frames[-1][2]
+        return 0
+
+    def text(self, start, end):
+        """Returns the characters of dataStream from start up to end."""
+        return self.dataStream[start:end]
+
+    def lookahead(self, terminator, maxLength):
+        """Returns the data stream from the current position up to and
+        including the next terminator without consuming it, reading more of
+        the document as needed. Returns None if the terminator is not within
+        maxLength, if it is not in the data fed so far or if characters were
+        pushed back. The result is raw: for UTF8InputStream it is bytes."""
+        if self.frames:
+            return None
+        start = self.tell
+        while True:
+            end = self.dataStream.find(terminator, start,
+              self.tell + maxLength)
+            if end != -1:
+                return self.dataStream[self.tell:end + 1]
+            if (len(self.dataStream) - self.tell >= maxLength or
+              self.closed or self.rawStream is None):
+                return None
+            # Only the new chunk needs searching
+            searched = self.offset + len(self.dataStream)
+            self.readChunk()
+            start = searched - self.offset
+
+    def skip(self, length):
+        """Consumes length items of the data stream, as counted in the
+        result of lookahead()."""
+        self.tell += length
 
     def charsUntil(self, characters, opposite=False):
         """Returns a string of characters from the stream up to but not
         including any character in characters or EOF. characters can be any
-        container that supports the in method being called on it.
+        hashable container of ASCII characters; it is used as the key of a
+        cached regular expression that matches the whole run at once.
         """
-        charStack = [self.char()]
+        try:
+            chars = charsUntilRegEx[(characters, opposite)]
+        except KeyError:
+            for c in characters:
+                assert ord(c) < 128
+            regex = "".join(["\\x%02x" % ord(c) for c in characters])
+            if not opposite:
+                regex = "^%s" % regex
+            chars = charsUntilRegEx[(characters, opposite)] =\
+              re.compile("[%s]*" % regex)
 
-        # First from the queue
-        while charStack[-1] and (charStack[-1] in characters) == opposite \
-          and self.queue:
-            charStack.append(self.queue.pop(0))
+        c = self.char()
+        if c is EOF or (c in characters) != opposite:
+            self.unget(c)
+            return u""
+        charStack = [c]
 
-        # Then the rest
-        while charStack[-1] and (charStack[-1] in characters) == opposite:
-            try:
-                self.tell += 1
-                charStack.append(self.dataStream[self.tell - 1])
-            except:
-                charStack.append(EOF)
-
-        # Put the character stopped on back to the front of the queue
-        # from where it came.
-        self.queue.insert(0, charStack.pop())
-        return "".join(charStack)
+        # First from the pushed back frames. A run can continue from one
+        # frame into the next and on into the data stream.
+        frames = self.frames
+        while frames:
+            frame = frames[-1]
+            text = frame[0]
+            offset = frame[1]
+            end = chars.match(text, offset).end()
+            if end > offset:
+                charStack.append(text[offset:end])
+            if end < len(text):
+                frame[1] = end
+                return "".join(charStack)
+            frames.pop()
+
+        # Then the rest as a single slice per chunk. The character stopped on
+        # is left in the stream.
+        while True:
+            end = chars.match(self.dataStream, self.tell).end()
+            charStack.append(self.text(self.tell, end))
+            self.tell = end
+            if (end < len(self.dataStream) or self.closed or
+              self.rawStream is None):
+                return "".join(charStack)
+            self.readChunk()
+
+# Bytes that start a UTF-8 sequence of two, three or four bytes
+utf8LeadBytes = [(2, "\xc0"), (3, "\xe0"), (4, "\xf0")]
+
+# A run of bytes that aren't ASCII
+nonASCIIRegEx = re.compile("[\x80-\xff]+")
+
+# The characters of the ASCII bytes
+asciiCharacters = dict([(chr(i), unichr(i)) for i in xrange(128)])
+
+class UTF8Passthrough(object):
+    """An incremental decoder that leaves UTF-8 as it is. A character cut
+    off at the end of a chunk is held back until the next one so chunks
+    always end between characters."""
+
+    def __init__(self):
+        self.pending = ""
+
+    def decode(self, data, final=False):
+        data = self.pending + data
+        self.pending = ""
+        if not final:
+            # Look back past the continuation bytes for the byte that
+            # started the last character
+            for i in xrange(1, min(len(data), 4) + 1):
+                c = data[-i]
+                if c < "\x80":
+                    break
+                if c >= "\xc0":
+                    for length, lead in reversed(utf8LeadBytes):
+                        if c >= lead:
+                            break
+                    if length > i:
+                        self.pending = data[-i:]
+                        data = data[:-i]
+                    break
+        return data
+
+class UTF8Transcoder(object):
+    """An incremental decoder for documents in other encodings than UTF-8
+    that encodes what it decodes as UTF-8."""
+
+    def __init__(self, encoding):
+        self.decoder = codecs.getincrementaldecoder(encoding)('replace')
+
+    def decode(self, data, final=False):
+        return self.decoder.decode(data, final).encode("utf-8")
+
+class UTF8InputStream(XMLInputStream):
+    """An XMLInputStream that keeps the document as UTF-8 bytes rather than
+    decoding all of it up front. As the characters that delimit markup are
+    all ASCII the runs charsUntil() stops at can be found in the bytes, and
+    only the runs that are returned are decoded. Documents in other
+    encodings are converted to UTF-8 as they are read.
+
+    Offsets, and so the columns of location(), count bytes rather than
+    characters.
+    """
+
+    replacementCharacter = u"\uFFFD".encode("utf-8")
+
+    def __init__(self, *args, **kwargs):
+        XMLInputStream.__init__(self, *args, **kwargs)
+        self.dataStream = ""
+
+    def getDecoder(self, encoding):
+        if codecs.lookup(encoding).name == "utf-8":
+            return UTF8Passthrough()
+        return UTF8Transcoder(encoding)
+
+    def char(self):
+        frames = self.frames
+        while frames:
+            frame = frames[-1]
+            offset = frame[1]
+            if offset < len(frame[0]):
+                frame[1] = offset + 1
+                return frame[0][offset]
+            frames.pop()
+
+        try:
+            c = asciiCharacters[self.dataStream[self.tell]]
+        except IndexError:
+            if self.closed:
+                return EOF
+            if self.rawStream is None:
+                raise NeedData
+            self.readChunk()
+            return self.char()
+        except KeyError:
+            # The whole run of characters that aren't ASCII is decoded and
+            # the ones after the first pushed back
+            end = nonASCIIRegEx.match(self.dataStream, self.tell).end()
+            text = self.text(self.tell, end)
+            self.tell = end
+            if len(text) > 1:
+                frames.append([text, 1, 0])
+            return text[0]
+        self.tell += 1
+        return c
+
+    def unget(self, c):
+        # Characters that aren't ASCII can't be compared with the bytes
+        # they were decoded from
+        if c is not EOF and c >= u"\x80" and not self.frames:
+            self.frames.append([c, 0, 0])
+        else:
+            XMLInputStream.unget(self, c)
+
+    def text(self, start, end):
+        return unicode(self.dataStream[start:end], "utf-8", "replace")
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+"""Builds a simpletree document and reports elements as they are opened and
+closed, so large documents can be processed without keeping all of them.
+
+  for event, element in iterparse(open("records.xml"), ("end",)):
+      if element.name == "record":
+          process(element)
+          # Drop the record and the text before it from the tree
+          element.parent.clear()
+
+When an "end" event is reported everything in the element's parent has
+been parsed, so clearing the parent at that point only drops nodes that
+were already seen. Elements that are still open are kept by the parser
+regardless; their attributes are needed to resolve namespaces.
+"""
+from parser import XMLParser
+from treebuilders import simpletree
+
+class EventTreeBuilder(simpletree.TreeBuilder):
+    """A simpletree TreeBuilder that records (event, node) pairs."""
+
+    def __init__(self, events):
+        self.events = []
+        self.start = "start" in events
+        self.end = "end" in events
+        self.comment = "comment" in events
+        self.pi = "pi" in events
+        simpletree.TreeBuilder.__init__(self)
+
+    def insertElement(self, name, attributes):
+        element = simpletree.TreeBuilder.insertElement(self, name,
+          attributes)
+        if self.start:
+            self.events.append(("start", element))
+        return element
+
+    def popElement(self):
+        element = simpletree.TreeBuilder.popElement(self)
+        if self.end:
+            self.events.append(("end", element))
+        return element
+
+    def insertComment(self, data):
+        comment = simpletree.TreeBuilder.insertComment(self, data)
+        if self.comment:
+            self.events.append(("comment", comment))
+        return comment
+
+    def insertPi(self, name, data):
+        pi = simpletree.TreeBuilder.insertPi(self, name, data)
+        if self.pi:
+            self.events.append(("pi", pi))
+        return pi
+
+    def endDocument(self):
+        # Elements left open are ended too, so every start has an end
+        while self.openElements:
+            self.popElement()
+
+def iterparse(source, events=("start", "end"), encoding=None):
+    """Parses source, a file-object or string, and yields (event, node)
+    pairs as the document is read. events can include "start" and "end"
+    for elements and "comment" and "pi"."""
+    for event in events:
+        if event not in ("start", "end", "comment", "pi"):
+            raise ValueError("Unknown event %r" % event)
+    parser = XMLParser(tree=lambda: EventTreeBuilder(events))
+    queue = parser.tree.events
+    for token in parser.parseTokens(source, encoding):
+        if queue:
+            for event in queue:
+                yield event
+            del queue[:]
+    for event in queue:
+        yield event
+    del queue[:]
@@ -1,97 +1,216 @@
 from tokenizer import XMLTokenizer
+from inputstream import mapFile
+from dtd import dtds
 
 import treebuilders
-from constants import spaceCharacters
+from constants import spaceCharacters, tokenTypes
 from treebuilders import simpletree
 
 class XMLParser(object):
-    def __init__(self, tree=simpletree.TreeBuilder):
+    def __init__(self, tree=simpletree.TreeBuilder, trackPositions=False,
+      entityLimits=None, scanBytes=False, dtdCache=dtds):
         self.tree = tree()
         self.errors = []
 
+        # When set tokens and nodes get a span, a pair of (line, col,
+        # offset) tuples for where they start and end in the source. An
+        # element's span runs from its start tag to the tag that closed it.
+        self.trackPositions = trackPositions
+
+        # An entities.EntityLimits that bounds entity expansion, or None
+        # for the defaults. After a parse entityStats holds the
+        # entities.EntityStats of what the document expanded.
+        self.entityLimits = entityLimits
+        self.entityStats = None
+
+        # When set the document is kept as UTF-8 bytes and only the parts
+        # that end up in tokens are decoded, see
+        # inputstream.UTF8InputStream. Offsets then count bytes.
+        self.scanBytes = scanBytes
+
+        # The dtd.DTDCache that compiled internal subsets are shared through
+        # and DTDs are looked up in by system identifier, or None
+        self.dtdCache = dtdCache
+
+        # A phase is a table of the methods that handle each kind of token,
+        # indexed by the kind.
         self.phases = {
-            "start":self.startPhase,
-            "main":self.mainPhase,
-            "end":self.endPhase
+            "start":self.dispatchTable(self.parseError,
+              StartTag=self.startPhaseStartTag,
+              EmptyTag=self.startPhaseEmptyTag,
+              Comment=self.insertComment,
+              Pi=self.insertPi,
+              Characters=self.documentCharacters),
+            "main":self.dispatchTable(self.ignore,
+              Characters=self.insertText,
+              StartTag=self.mainPhaseStartTag,
+              EmptyTag=self.mainPhaseEmptyTag,
+              EndTag=self.mainPhaseEndTag,
+              EndTagShort=self.mainPhaseEndTagShort,
+              Comment=self.insertComment,
+              Pi=self.insertPi),
+            "end":self.dispatchTable(self.parseError,
+              Comment=self.insertComment,
+              Pi=self.insertPi,
+              Characters=self.documentCharacters)
         }
         self.phase = self.phases["start"]
 
+        # Set while a document is being passed in with feed()
+        self.feeding = False
+
     def _parse(self, stream, encoding=None):
+        for token in self.parseTokens(stream, encoding):
+            pass
+
+    def parseTokens(self, stream, encoding=None):
+        """Builds the tree like parse() does but yields each token after it
+        has been added, so the tree can be looked at and pruned while it is
+        being built."""
         self.tree.reset()
         self.errors = []
-        self.tokenizer = XMLTokenizer(stream, encoding)
+        self.phase = self.phases["start"]
+        self.tokenizer = XMLTokenizer(stream, encoding, self.trackPositions,
+          self.entityLimits, self.scanBytes, self.dtdCache)
+        self.entityStats = self.tokenizer.entityStats
 
         for token in self.tokenizer:
-            self.phase(token)
+            self.phase[token.kind](token)
+            yield token
         # When the loop finishes it's EOF
         # XXX
+        self.tree.endDocument()
 
     def parse(self, stream, encoding=None):
         self._parse(stream, encoding=encoding)
         return self.tree.getDocument()
 
+    def parseFile(self, path, encoding=None):
+        """Parses the file at path. It is memory mapped where possible, so
+        the encoding is detected from and the chunks are read out of the
+        mapped pages instead of a copy of the file."""
+        source = mapFile(path)
+        try:
+            return self.parse(source, encoding)
+        finally:
+            source.close()
+
+    def feed(self, data, encoding=None):
+        """Parses the next chunk of bytes of a document. The tree is built
+        as far as the data allows; call close() after the last chunk to get
+        the document. encoding is only used with the first chunk."""
+        if not self.feeding:
+            self.tree.reset()
+            self.errors = []
+            self.phase = self.phases["start"]
+            self.tokenizer = XMLTokenizer(None, encoding,
+              self.trackPositions, self.entityLimits, self.scanBytes,
+              self.dtdCache)
+            self.entityStats = self.tokenizer.entityStats
+            self.feeding = True
+        for token in self.tokenizer.feed(data):
+            self.phase[token.kind](token)
+
+    def close(self):
+        """Finishes a document passed in with feed() and returns it."""
+        if not self.feeding:
+            self.feed("")
+        for token in self.tokenizer.close():
+            self.phase[token.kind](token)
+        self.tree.endDocument()
+        self.feeding = False
+        return self.tree.getDocument()
+
+    def dispatchTable(self, default, **handlers):
+        table = [default] * len(tokenTypes)
+        for name, handler in handlers.items():
+            table[tokenTypes[name]] = handler
+        return table
+
+    def spanNode(self, node, token):
+        """Gives node the span of token if positions are tracked."""
+        if self.trackPositions:
+            node.span = token.span
+        return node
+
+    def popElement(self, token):
+        """Pops the current node, which is closed by token."""
+        element = self.tree.popElement()
+        if self.trackPositions:
+            element.span = (element.span[0], token.span[1])
+
+    def insertText(self, token):
+        text = self.tree.insertText(token.data)
+        if self.trackPositions and text is not None:
+            # Adjacent text is merged into one node whose span grows
+            if text.span is None:
+                text.span = token.span
+            else:
+                text.span = (text.span[0], token.span[1])
+
     def containsWhiteSpace(self, string):
         for c in string:
             if c not in spaceCharacters:
                 return False
         return True
 
-    def startPhase(self, token):
-        if token["type"] == "StartTag":
-            element = self.tree.createElement(token["name"], token["attributes"])
-            self.tree.document.appendChild(element)
-            self.tree.openElements.append(element)
-            self.phase = self.phases["main"]
-        elif token["type"] == "EmptyTag":
-            element = self.tree.createElement(token["name"], token["attributes"])
-            self.tree.document.appendChild(element)
-            self.phase = self.phases["end"]
-        elif token["type"] == "Comment":
-            self.tree.document.appendChild(self.tree.commentClass(token["data"]))
-        elif token["type"] == "Pi":
-            self.tree.document.appendChild(self.tree.piClass(token["name"], token["data"]))
-        elif token["type"] == "Characters" and self.containsWhiteSpace(token["data"]):
-            pass
-        else:
+    def insertComment(self, token):
+        self.spanNode(self.tree.insertComment(token.data), token)
+
+    def insertPi(self, token):
+        self.spanNode(self.tree.insertPi(token.name, token.data), token)
+
+    def documentCharacters(self, token):
+        if not self.containsWhiteSpace(token.data):
             # XXX parse error
             pass
 
-    def mainPhase(self, token):
-        if token["type"] == "Characters":
-            self.tree.insertText(token["data"])
-        elif token["type"] == "StartTag":
-            element = self.tree.createElement(token["name"], token["attributes"])
-            self.tree.openElements[-1].appendChild(element)
-            self.tree.openElements.append(element)
-        elif token["type"] == "EmptyTag":
-            element = self.tree.createElement(token["name"], token["attributes"])
-            self.tree.openElements[-1].appendChild(element)
-        elif token["type"] == "EndTag":
-            if self.tree.openElements[-1].name != token["name"]:
-                # XXX parse error
-                pass
-            if self.tree.elementInScope(token["name"]):
-                while self.tree.openElements[-1].name != token["name"]:
-                    self.tree.openElements.pop()
-                self.tree.openElements.pop()
-                if len(self.tree.openElements) == 0:
-                    self.phase = self.phases["end"]
-        elif token["type"] == "EndTagShort":
-            self.tree.openElements.pop()
-            if len(self.tree.openElements) == 0:
-                self.phase = self.phases["end"]
-        elif token["type"] == "Comment":
-            self.tree.openElements[-1].appendChild(self.tree.commentClass(token["data"]))
-        elif token["type"] == "Pi":
-            self.tree.openElements[-1].appendChild(self.tree.piClass(token["name"], token["data"]))
-
-    def endPhase(self, token):
-        if token["type"] == "Comment":
-            self.tree.document.appendChild(self.tree.commentClass(token["data"]))
-        elif token["type"] == "Pi":
-            self.tree.document.appendChild(self.tree.piClass(token["name"], token["data"]))
-        elif token["type"] == "Characters" and self.containsWhiteSpace(token["data"]):
-            pass
-        else:
+    def parseError(self, token):
+        # XXX parse error
+        pass
+
+    def ignore(self, token):
+        pass
+
+    def startPhaseStartTag(self, token):
+        self.spanNode(self.tree.insertElement(token.name, token.attributes),
+          token)
+        self.phase = self.phases["main"]
+
+    def startPhaseEmptyTag(self, token):
+        self.spanNode(self.tree.insertElement(token.name, token.attributes),
+          token)
+        self.popElement(token)
+        self.phase = self.phases["end"]
+
+    def mainPhaseStartTag(self, token):
+        self.spanNode(self.tree.insertElement(token.name, token.attributes),
+          token)
+
+    def mainPhaseEmptyTag(self, token):
+        self.spanNode(self.tree.insertElement(token.name, token.attributes),
+          token)
+        self.popElement(token)
+
+    def mainPhaseEndTag(self, token):
+        # Tag names come from the symbol table so they are usually the same
+        # object when they are equal
+        name = token.name
+        current = self.tree.openElements[-1].name
+        if current is not name and current != name:
             # XXX parse error
             pass
+        if self.tree.elementInScope(name):
+            while True:
+                current = self.tree.openElements[-1].name
+                if current is name or current == name:
+                    break
+                self.popElement(token)
+            self.popElement(token)
+            if len(self.tree.openElements) == 0:
+                self.phase = self.phases["end"]
+
+    def mainPhaseEndTagShort(self, token):
+        self.popElement(token)
+        if len(self.tree.openElements) == 0:
+            self.phase = self.phases["end"]
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+"""Serializes simpletree nodes, or any nodes with the same attributes and a
+nodeType, without recursion.
+
+There are three methods:
+
+  xml     the node as XML
+  hilite  XML escaped for HTML, with markup wrapped in <code> elements
+  tree    the format of printTree() that the tests are written in
+
+serialize() encodes the output and writes it to a file-like object in
+chunks, so the whole document is never held in memory as a string.
+"""
+import re
+
+# Node types, as in the DOM
+ELEMENT_NODE = 1
+TEXT_NODE = 3
+PROCESSING_INSTRUCTION_NODE = 7
+COMMENT_NODE = 8
+DOCUMENT_NODE = 9
+
+textSpecialRegEx = re.compile(u"[&<>]")
+attributeSpecialRegEx = re.compile(u"[&<>\"]")
+
+def escape(data):
+    """Escapes &, < and > like xml.sax.saxutils.escape."""
+    if textSpecialRegEx.search(data) is None:
+        return data
+    return data.replace(u"&", u"&amp;").replace(u">", u"&gt;").replace(
+      u"<", u"&lt;")
+
+def escapeAttribute(data):
+    if attributeSpecialRegEx.search(data) is None:
+        return data
+    return escape(data).replace(u"\"", u"&quot;")
+
+class BufferedWriter(object):
+    """Collects strings and writes them to stream encoded, bufferSize
+    characters at a time."""
+
+    def __init__(self, stream, encoding="utf-8", bufferSize=65536):
+        self.stream = stream
+        self.encoding = encoding
+        self.bufferSize = bufferSize
+        self.buffer = []
+        self.size = 0
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.size += len(data)
+        if self.size >= self.bufferSize:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            data = u"".join(self.buffer)
+            if self.encoding is not None:
+                data = data.encode(self.encoding)
+            self.stream.write(data)
+            self.buffer = []
+            self.size = 0
+
+def walk(node, startTag, endTag, emptyTag, leaf):
+    """Yields the strings that make up node. Elements with children are
+    passed to startTag and endTag, elements without to emptyTag and other
+    nodes to leaf; each returns a string. A Document only yields its
+    children."""
+    if node.nodeType == DOCUMENT_NODE:
+        stack = list(reversed(node.childNodes))
+    else:
+        stack = [node]
+    while stack:
+        node = stack.pop()
+        if node is None:
+            # The end of the element below it on the stack
+            yield endTag(stack.pop())
+        elif node.nodeType == ELEMENT_NODE:
+            if node.childNodes:
+                yield startTag(node)
+                stack.append(node)
+                stack.append(None)
+                stack.extend(reversed(node.childNodes))
+            else:
+                yield emptyTag(node)
+        else:
+            yield leaf(node)
+
+def attributesToXML(element):
+    if not element.attributes:
+        return u""
+    return u"".join([u" %s=\"%s\"" % (attribute.name,
+      escapeAttribute(attribute.value))
+      for attribute in element.attributes])
+
+def leafToXML(node):
+    if node.nodeType == TEXT_NODE:
+        return escape(node.value)
+    elif node.nodeType == COMMENT_NODE:
+        return u"<!--%s-->" % node.data
+    elif node.nodeType == PROCESSING_INSTRUCTION_NODE:
+        return u"<?%s %s?>" % (node.name, node.data)
+    raise TypeError("Can't serialize %r" % node)
+
+def walkXML(node):
+    return walk(node,
+      lambda element: u"<%s%s>" % (element.name, attributesToXML(element)),
+      lambda element: u"</%s>" % element.name,
+      lambda element: u"<%s%s/>" % (element.name, attributesToXML(element)),
+      leafToXML)
+
+def leafToHilite(node):
+    if node.nodeType == TEXT_NODE:
+        return escape(node.value)
+    elif node.nodeType == COMMENT_NODE:
+        return u"<code class=\"markup comment\">&lt;!--%s--></code>" % \
+          escape(node.data)
+    elif node.nodeType == PROCESSING_INSTRUCTION_NODE:
+        return u"<code class=\"markup pi\">&lt;?%s %s?></code>" % \
+          (escape(node.name), escape(node.data))
+    raise TypeError("Can't serialize %r" % node)
+
+def walkHilite(node):
+    return walk(node,
+      lambda element: u"<code class=\"markup element\">&lt;%s%s></code>" %
+        (escape(element.name), escape(attributesToXML(element))),
+      lambda element: u"<code class=\"markup element\">&lt;/%s></code>" %
+        escape(element.name),
+      lambda element: u"<code class=\"markup element\">&lt;%s%s/></code>" %
+        (escape(element.name), escape(attributesToXML(element))),
+      leafToHilite)
+
+def walkTree(node, indent=0):
+    """Yields the lines of printTree(), each starting with a new line.
+    Children are indented two more spaces than their parent."""
+    if node.nodeType == DOCUMENT_NODE:
+        stack = [(child, 1) for child in reversed(node.childNodes)]
+    else:
+        stack = [(node, indent)]
+    while stack:
+        node, indent = stack.pop()
+        if node.nodeType == ELEMENT_NODE:
+            yield u"\n|%s<%s> (%s, %s, %s)" % (u" " * indent, node.name,
+              node.prefix, node.localname, node.namespace)
+            indent += 2
+            if node.attributes:
+                for attribute in sorted(node.attributes,
+                  key=lambda attribute: attribute.name):
+                    yield u"\n|%s%s=\"%s\" (%s, %s, %s)" % (u" " * indent,
+                      attribute.name, attribute.value, attribute.prefix,
+                      attribute.localname, attribute.namespace)
+        else:
+            yield u"\n|%s%s" % (u" " * indent, unicode(node))
+            indent += 2
+        stack.extend([(child, indent) for child in reversed(node.childNodes)])
+
+methods = {
+  "xml":walkXML,
+  "hilite":walkHilite,
+  "tree":walkTree
+}
+
+def serialize(node, stream, encoding="utf-8", method="xml"):
+    """Writes node to stream. If encoding is None unicode strings are
+    written."""
+    if method not in methods:
+        raise ValueError("Unknown method %r" % method)
+    writer = BufferedWriter(stream, encoding)
+    if method == "hilite" and node.nodeType == DOCUMENT_NODE:
+        writer.write(u"<pre>")
+    elif method == "tree" and node.nodeType == DOCUMENT_NODE:
+        writer.write(u"#document")
+    for data in methods[method](node):
+        writer.write(data)
+    if method == "hilite" and node.nodeType == DOCUMENT_NODE:
+        writer.write(u"</pre>")
+    writer.flush()
+
+def toString(node, method="xml"):
+    """Returns node serialized as a unicode string."""
+    return u"".join(methods[method](node))
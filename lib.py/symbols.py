@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+"""A table of the names seen by the parser, shared by all parses in the
+process.
+
+Documents tend to use a few hundred distinct names many times over. The
+table hands out one string object per name so nodes share them, names can
+be compared by identity first, and qualified names are only split into
+prefix and local name once.
+"""
+
+class SymbolTable(object):
+    # Strings longer than this are not worth keeping as attribute values
+    maxValueLength = 64
+
+    def __init__(self, maxSize=100000, maxValues=10000):
+        """maxSize bounds the number of names and of qualified names kept,
+        so documents with endless distinct names can't grow the table
+        forever. Past it names are returned as they are.
+
+        Attribute values are kept apart, at most maxValues of them, so they
+        can't crowd out the names. Values vary far more than names do, so
+        when the values are full they are dropped and collected afresh."""
+        self.maxSize = maxSize
+        self.maxValues = maxValues
+        self.strings = {}
+        self.values = {}
+        self.qualifiedNames = {}
+
+    def intern(self, string):
+        """Returns the table's copy of string, adding it if there is room."""
+        try:
+            return self.strings[string]
+        except KeyError:
+            if len(self.strings) < self.maxSize:
+                self.strings[string] = string
+            return string
+
+    def internValue(self, value):
+        """Like intern() for attribute values, which are only kept if they
+        are short."""
+        if len(value) > self.maxValueLength:
+            return value
+        try:
+            return self.values[value]
+        except KeyError:
+            if len(self.values) >= self.maxValues:
+                self.values.clear()
+            self.values[value] = value
+            return value
+
+    def qualifiedName(self, name):
+        """Returns (name, prefix, localname) for a qualified name, with
+        prefix "" if there is none."""
+        try:
+            return self.qualifiedNames[name]
+        except KeyError:
+            if name.find(":") != -1:
+                prefix, localname = name.split(":", 1)
+            else:
+                prefix, localname = "", name
+            record = (self.intern(name), self.intern(prefix),
+              self.intern(localname))
+            if len(self.qualifiedNames) < self.maxSize:
+                self.qualifiedNames[name] = record
+            return record
+
+    def clear(self):
+        self.strings.clear()
+        self.values.clear()
+        self.qualifiedNames.clear()
+
+# The table used by the parser
+symbols = SymbolTable()
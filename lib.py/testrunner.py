@@ -1,22 +1,139 @@
+#!/usr/bin/env python
+"""Runs the tree construction tests over a pool of worker processes.
+
+  python testrunner.py [-j 4] [--json report.json] [--junit report.xml]
+
+Without file arguments tests/tree-construction1 and tests/needs-fixing are
+run, followed by the tests of the Python API in apitests.py. Every case is
+parsed as a whole, fed one byte at a time and scanned as UTF-8 bytes, and
+each must give the expected tree. The time it takes to tokenize the case
+and to build its tree is recorded.
+
+With --scaling each case is also repeated until it is scaleFactor times
+as long and timed again. A case whose time grows by more than slowFactor
+times the growth of its input is slow, as the tokenizer or tree builder
+probably does something quadratic with it, and counts as a failure.
+
+The exit status is 1 if any case or API test failed.
+"""
+import os
+import sys
+import time
+
 from parser import XMLParser
-def runtests(filename):
+from tokenizer import XMLTokenizer
+
+testDirectory = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+  "..", "tests")
+
+# The scaling check times a case repeated to at least baseSize characters
+# and then scaleFactor times that. Short cases are repeated to baseSize
+# first so the timings are long enough to compare.
+baseSize = 4096
+scaleFactor = 8
+slowFactor = 2.0
+
+def timeParse(input):
+    """Returns (tokenizer seconds, tree seconds) for input. The tree time is
+    the time of a whole parse less that of tokenizing."""
+    start = time.time()
+    for token in XMLTokenizer(input):
+        pass
+    tokenizeSeconds = time.time() - start
+    start = time.time()
+    XMLParser().parse(input)
+    parseSeconds = time.time() - start
+    return tokenizeSeconds, max(parseSeconds - tokenizeSeconds, 0.0)
+
+def runCase(case):
+    """Runs one (filename, index, input, expected, scaling) case and returns
+    (filename, index, failures, tokenizer seconds, tree seconds, growth)
+    where failures is a list of (mode, result) pairs and growth is how much
+    slower the scaled input was relative to its size, or None."""
+    filename, index, input, expected, scaling = case
+    expected = "#document\n" + expected
+    failures = []
+    tokenizeSeconds, treeSeconds = timeParse(input)
+
+    parser = XMLParser()
+    result = parser.parse(input).printTree()
+    if result != expected:
+        failures.append(("parse", result))
+    else:
+        # The same document fed one byte at a time
+        for c in input:
+            parser.feed(c)
+        result = parser.close().printTree()
+        if result != expected:
+            failures.append(("fed", result))
+        # The same document scanned as UTF-8 bytes
+        result = XMLParser(scanBytes=True).parse(input).printTree()
+        if result != expected:
+            failures.append(("bytes", result))
+
+    growth = None
+    if scaling and input:
+        base = input * (baseSize // len(input) + 1)
+        before = sum(timeParse(base))
+        after = sum(timeParse(base * scaleFactor))
+        growth = after / max(before, 1e-6) / scaleFactor
+    return (filename, index, failures, tokenizeSeconds, treeSeconds, growth)
+
+def isSlow(result):
+    return result[5] is not None and result[5] > slowFactor
+
+def readCases(filename, scaling=False):
     f = open(filename)
-    tests = f.read().split("#data\n")
-    errorAmount = index = 0
-    errorLog = []
+    try:
+        tests = f.read().split("#data\n")
+    finally:
+        f.close()
+    cases = []
     for index, test in enumerate(tests):
         if test == "": continue
-        test = "#data\n" + test
-        input, expected, errors = parseTestcase(test)
-        parser = XMLParser()
-        result = parser.parse(input).printTree()
-        if result != "#document\n" + expected:
-            errorAmount += 1
-            errorLog.append("For:\n" + input + "\nExpected:\n" + expected + "\nGot:\n" + result + "\n\n")
-    if errorAmount == 0:
+        input, expected, errors = parseTestcase("#data\n" + test)
+        cases.append((filename, index, input, expected, scaling))
+    return cases
+
+def runCases(cases, workers=None):
+    """Runs cases over a pool of worker processes, in this process if
+    workers is 1, and returns the results of runCase() in the order of
+    cases."""
+    if workers == 1:
+        return map(runCase, cases)
+    import multiprocessing
+    pool = multiprocessing.Pool(workers)
+    try:
+        return pool.map(runCase, cases, 1)
+    finally:
+        pool.close()
+        pool.join()
+
+def runtests(filename, workers=None, scaling=False):
+    """Runs the cases in filename and prints "All Good!" or the cases that
+    failed or were slow. Returns the results of runCase() together with the
+    cases."""
+    cases = readCases(filename, scaling)
+    results = runCases(cases, workers)
+    errorLog = []
+    for case, result in zip(cases, results):
+        for mode, got in result[2]:
+            if mode == "parse":
+                label = "For"
+            else:
+                label = "For (%s)" % mode
+            errorLog.append(label + ":\n" + case[2] + "\nExpected:\n" +
+              case[3] + "\nGot:\n" + got + "\n\n")
+    slow = [(case, result) for case, result in zip(cases, results)
+      if isSlow(result)]
+    if not errorLog and not slow:
         print "All Good!"
-    else:
+    elif errorLog:
         print "\n" + "".join(errorLog)
+    for case, result in slow:
+        print "Slow (%.1fx the input growth): %s #%d %r" % (result[5],
+          os.path.basename(filename), result[1], case[2][:60])
+    return zip(cases, results)
 
 def parseTestcase(testString):
     testString = testString.split("\n")
@@ -43,9 +160,95 @@ def parseTestcase(testString):
             currentList = expected
     return "\n".join(input), "\n".join(expected), errors
 
+def writeJSON(path, runs):
+    import json
+    report = []
+    for case, result in runs:
+        filename, index, failures, tokenizeSeconds, treeSeconds, growth =\
+          result
+        report.append({
+          "file":os.path.basename(filename),
+          "index":index,
+          "input":case[2],
+          "failures":[mode for mode, got in failures],
+          "tokenizeSeconds":tokenizeSeconds,
+          "treeSeconds":treeSeconds,
+          "growth":growth,
+          "slow":isSlow(result)
+        })
+    out = open(path, "w")
+    try:
+        json.dump(report, out, indent=1, sort_keys=True)
+        out.write("\n")
+    finally:
+        out.close()
+
+def writeJUnit(path, runs):
+    from xml.sax.saxutils import quoteattr, escape
+    suites = {}
+    for case, result in runs:
+        suites.setdefault(os.path.basename(result[0]), []).append(
+          (case, result))
+    out = open(path, "w")
+    try:
+        out.write('<?xml version="1.0" encoding="utf-8"?>\n<testsuites>\n')
+        for name in sorted(suites):
+            runs = suites[name]
+            failed = len([result for case, result in runs
+              if result[2] or isSlow(result)])
+            out.write('<testsuite name=%s tests="%d" failures="%d">\n' %
+              (quoteattr(name), len(runs), failed))
+            for case, result in runs:
+                out.write('<testcase classname=%s name="%d" time="%f">' %
+                  (quoteattr(name), result[1], result[3] + result[4]))
+                for mode, got in result[2]:
+                    message = "Expected:\n%s\nGot:\n%s" % (case[3], got)
+                    out.write('<failure message=%s>%s</failure>' %
+                      (quoteattr("%s mismatch" % mode),
+                      escape(message).encode("utf-8")))
+                if isSlow(result):
+                    out.write('<failure message="slow">%.1fx the input '
+                      'growth</failure>' % result[5])
+                out.write('</testcase>\n')
+            out.write('</testsuite>\n')
+        out.write('</testsuites>\n')
+    finally:
+        out.close()
+
+def main(argv=None):
+    from optparse import OptionParser
+    optionParser = OptionParser(usage="%prog [options] [testfile ...]")
+    optionParser.add_option("-j", "--workers", type="int",
+      help="number of worker processes [number of CPUs]")
+    optionParser.add_option("--scaling", default=False, action="store_true",
+      help="time the cases scaled up and fail those that are slow")
+    optionParser.add_option("--json", help="write a JSON report to this file")
+    optionParser.add_option("--junit",
+      help="write a JUnit XML report to this file")
+    options, args = optionParser.parse_args(argv)
+
+    filenames = args or [os.path.join(testDirectory, "tree-construction1"),
+      os.path.join(testDirectory, "needs-fixing")]
+    runs = []
+    for filename in filenames:
+        if not args and filename.endswith("needs-fixing"):
+            print "Run tests that need fixing..."
+        runs.extend(runtests(filename, options.workers, options.scaling))
+    if options.json:
+        writeJSON(options.json, runs)
+    if options.junit:
+        writeJUnit(options.junit, runs)
+    failed = len([result for case, result in runs
+      if result[2] or isSlow(result)])
+    if not args:
+        print "Run API tests..."
+        import unittest
+        import apitests
+        if not unittest.TextTestRunner().run(apitests.suite()).wasSuccessful():
+            failed += 1
+    if failed:
+        return 1
+    return 0
+
 if __name__ == "__main__":
-    import sys
-    runtests("../tests/tree-construction1")
-    if sys.argv[-1] == "testrunner.py":
-        print "Run tests that need fixing..."
-        runtests("../tests/needs-fixing")
+    sys.exit(main())
@@ -1,11 +1,113 @@
 from constants import spaceCharacters, digits, hexDigits, EOF
-from inputstream import XMLInputStream
-import re
+from constants import tokenTypes, tokenTypeNames, tagTokenTypes
+from inputstream import XMLInputStream, UTF8InputStream, NeedData
+from symbols import symbols
+from entities import Replacement, EntityLimits, EntityStats
+from entities import EntityLimitExceeded
+from dtd import DTD, dtds, attributeDefaults
+
+# Characters that end the runs consumed in one go by the various states.
+tagNameStop = spaceCharacters | frozenset((u">", u"/"))
+endTagNameStop = spaceCharacters | frozenset((u">",))
+attributeNameStop = spaceCharacters | frozenset((u"=", u">", u"/"))
+piTargetStop = spaceCharacters | frozenset((u"?",))
+doctypeRootNameStop = spaceCharacters | frozenset((u">", u"["))
+doctypeIdentifierStop = frozenset((u">", u"\"", u"'", u"["))
+doctypeInternalSubsetStop = frozenset((u"<", u"%", u"]"))
+dataStop = frozenset((u"&", u"<"))
+attributeValueUnquotedStop = spaceCharacters | frozenset((u"&", u">", u"<"))
+doctypeEntityIdentifierStop = frozenset((u">", u"\"", u"'"))
+
+# The entities every document starts with
+predefinedEntities = {
+  "lt":"&#60;",
+  "gt":">",
+  "amp":"&#38;",
+  "apos":"'",
+  "quot":"\""
+}
+
+class Token(object):
+    """A token emitted by the tokenizer. kind is one of tokenTypes.
+
+    Tokens can also be read as the dictionaries the tokenizer used to emit,
+    where token["type"] is the name of the kind.
+    """
+    __slots__ = ("span",)
+
+    def __getitem__(self, key):
+        if key == "type":
+            return tokenTypeNames[self.kind]
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __repr__(self):
+        return "<%s %s>" % (tokenTypeNames[self.kind], " ".join(["%s=%r" %
+          (key, getattr(self, key)) for key in self.__slots__
+          if key != "kind" and hasattr(self, key)]))
+
+class Characters(Token):
+    __slots__ = ("data",)
+    kind = tokenTypes["Characters"]
+
+    def __init__(self, data):
+        self.data = data
+
+class Tag(Token):
+    """StartTag, EmptyTag and EndTag tokens. attributes is a list of
+    [name, value] lists, or None for end tags."""
+    __slots__ = ("kind", "name", "attributes")
+
+    def __init__(self, kind, name, attributes=None):
+        self.kind = kind
+        self.name = name
+        self.attributes = attributes
+
+class EndTagShort(Token):
+    __slots__ = ()
+    kind = tokenTypes["EndTagShort"]
+
+class Comment(Token):
+    __slots__ = ("data",)
+    kind = tokenTypes["Comment"]
+
+    def __init__(self, data):
+        self.data = data
+
+class Pi(Token):
+    __slots__ = ("name", "data")
+    kind = tokenTypes["Pi"]
+
+    def __init__(self, name, data):
+        self.name = name
+        self.data = data
 
 class XMLTokenizer(object):
-    def __init__(self, stream, encoding=None):
-        # The stream holds all the characters.
-        self.stream = XMLInputStream(stream, self, encoding)
+    def __init__(self, stream, encoding=None, trackPositions=False,
+      entityLimits=None, scanBytes=False, dtdCache=dtds):
+        # The stream holds all the characters. With scanBytes it keeps them
+        # as UTF-8 and only decodes the runs that are read.
+        if scanBytes:
+            streamClass = UTF8InputStream
+        else:
+            streamClass = XMLInputStream
+        self.stream = streamClass(stream, self, encoding, trackPositions)
+
+        # With trackPositions every token gets a "span" of (line, col,
+        # offset) tuples for where it starts and ends in the source.
+        self.trackPositions = trackPositions
+        self.tokenStart = None
 
         # Set of states and the initial state
         self.states = {
@@ -88,33 +190,202 @@ class XMLTokenizer(object):
         self.currentToken = None
 
         # Entities
-        self.entities = {
-          "lt":"&#60;",
-          "gt":">",
-          "amp":"&#38;",
-          "apos":"'",
-          "quot":"\""
-        }
+        self.entities = dict(predefinedEntities)
         self.parameterEntities = {}
         self.attributeNormalization = []
 
-        # Dealing with entities
-        self.entityValueLen = 0
-        self.charCount = 0
-        self.entityCount = 0
+        # The default attributes of attributeNormalization by element name,
+        # see dtd.attributeDefaults(), and the list and length they were
+        # compiled from. They are compiled again when the list changes.
+        self.attributeDefaults = {}
+        self.attributeDefaultsSource = (self.attributeNormalization, 0)
+
+        # Names of the attributes of the current tag, for spotting
+        # duplicates
+        self.attributeNames = set()
+
+        # The text of the comment, PI or attribute value being read, joined
+        # into the token at its end so long ones don't take quadratic time
+        self.pieces = []
+
+        # Replacement text of the entities referenced so far, by name
+        self.replacements = {}
+
+        # Bounds on entity expansion and what was expanded so far
+        if entityLimits is None:
+            entityLimits = EntityLimits()
+        self.entityLimits = entityLimits
+        self.entityStats = EntityStats()
+
+        # Compiled DTDs shared with other documents, see dtd.DTDCache, or
+        # None. An internal subset that isn't in the cache is added to it
+        # at its end, if it ends where expected; pendingSubset is (key, end
+        # offset, entity stats at the start) of that subset.
+        self.dtdCache = dtdCache
+        self.pendingSubset = None
+
+        # The public and system identifiers of the DOCTYPE. Only the system
+        # identifier is looked up in the catalog of dtdCache. While the
+        # DOCTYPE is read doctypeKeyword is the last word before its first
+        # literal, "PUBLIC" or "SYSTEM", and doctypeLiterals the quoted
+        # literals so far.
+        self.publicIdentifier = None
+        self.systemIdentifier = None
+        self.doctypeKeyword = None
+        self.doctypeLiterals = []
 
         # Tokens yet to be processed.
         self.tokenQueue = []
 
+        # Where to resume from when the stream runs out of data in feed
+        # mode, see pump().
+        self.checkpoint = None
+
     def __iter__(self):
         self.stream.reset()
         self.tokenQueue = []
 
         # Start processing. When EOF is reached self.state will return False
         # instead of True and the loop will terminate.
-        while self.state():
-            while self.tokenQueue:
-                yield self.tokenQueue.pop(0)
+        if not self.trackPositions:
+            while self.state():
+                while self.tokenQueue:
+                    yield self.tokenQueue.pop(0)
+        else:
+            self.tokenStart = self.stream.location()
+            more = True
+            while more:
+                more = self.trackState()
+                while self.tokenQueue:
+                    yield self.tokenQueue.pop(0)
+
+    def feed(self, data):
+        """Appends data to a stream created without a source and returns the
+        list of tokens that can be produced from the input so far."""
+        self.stream.feed(data)
+        return self.pump()
+
+    def close(self):
+        """Ends the input of a fed stream and returns the remaining tokens."""
+        self.stream.close()
+        return self.pump()
+
+    def pump(self):
+        """Runs the states over the input that is available and returns the
+        tokens produced.
+
+        A state can run out of input halfway through a token. The tokenizer
+        then goes back to the last checkpoint, the point where the previous
+        token ended, and starts over from there once more data has been fed.
+        Checkpoints are also taken inside the internal subset between
+        declarations so the subset is not parsed again from the start, and
+        inside the bodies of comments, processing instructions and attribute
+        values, together with the token so far, so a long body that arrives
+        in many chunks is only scanned once.
+        """
+        tokens = []
+        trackPositions = self.trackPositions
+        if trackPositions and self.tokenStart is None:
+            self.tokenStart = self.stream.location()
+        if self.checkpoint is None:
+            self.saveCheckpoint()
+        quiescentStates = (self.states["data"],
+          self.states["doctypeInternalSubset"])
+        states = self.states
+        tokenStates = (states["comment"], states["commentDash"],
+          states["commentEnd"], states["piContent"], states["piAfter"],
+          states["tagAttributeValueDoubleQuoted"],
+          states["tagAttributeValueSingleQuoted"],
+          states["tagAttributeValueUnquoted"])
+        while True:
+            try:
+                if trackPositions:
+                    more = self.trackState()
+                else:
+                    more = self.state()
+            except NeedData:
+                self.restoreCheckpoint()
+                break
+            if self.tokenQueue:
+                tokens.extend(self.tokenQueue)
+                self.tokenQueue = []
+                self.saveCheckpoint()
+            elif self.state in quiescentStates:
+                self.saveCheckpoint()
+            elif self.state in tokenStates:
+                self.saveCheckpoint(True)
+            if not more:
+                break
+        return tokens
+
+    def trackState(self):
+        """Runs the current state like self.state() and sets the span of
+        the tokens it emits. A token starts where the previous one ended, or
+        where the tokenizer last came back to the data state, so text in
+        between like a DOCTYPE is not part of the next token."""
+        state = self.state
+        more = state()
+        if self.tokenQueue:
+            end = self.stream.location()
+            span = (self.tokenStart, end)
+            for token in self.tokenQueue:
+                token.span = span
+            self.tokenStart = end
+        elif self.state == self.dataState and state != self.dataState:
+            self.tokenStart = self.stream.location()
+        return more
+
+    def saveCheckpoint(self, inToken=False):
+        # Between tokens currentToken doesn't need saving. Inside one,
+        # inToken is set and what the states add to it is saved: the pieces
+        # read so far, the data of a comment or PI, or the attributes of a
+        # tag. Entities and ATTLIST declarations are only added at the end
+        # of a declaration, right before the next checkpoint, so only the
+        # number of ATTLIST declarations is needed to undo those that were
+        # cut off. The tables themselves are saved too as a DOCTYPE replaces
+        # them when it uses a cached DTD.
+        token = None
+        if inToken:
+            token = self.currentToken
+            if token.kind in tagTokenTypes:
+                token = (token, self.pieces, len(self.pieces),
+                  len(token.attributes), token.attributes[-1][1],
+                  set(self.attributeNames))
+            else:
+                token = (token, self.pieces, len(self.pieces), token.data)
+        self.checkpoint = (self.state, self.stream.mark(),
+          self.entityStats.save(), self.entities, self.parameterEntities,
+          self.attributeNormalization, len(self.attributeNormalization),
+          self.tokenStart, token)
+
+    def restoreCheckpoint(self):
+        (self.state, mark, entityStats, self.entities,
+          self.parameterEntities, self.attributeNormalization,
+          attributeNormalizationLen, self.tokenStart, token) =\
+          self.checkpoint
+        self.stream.rewind(mark)
+        self.entityStats.restore(entityStats)
+        del self.attributeNormalization[attributeNormalizationLen:]
+        if token is None:
+            self.pieces = []
+        else:
+            self.currentToken = token[0]
+            self.pieces = token[1]
+            del self.pieces[token[2]:]
+            if len(token) == 6:
+                attributes = self.currentToken.attributes
+                del attributes[token[3]:]
+                attributes[-1][1] = token[4]
+                self.attributeNames = set(token[5])
+            else:
+                self.currentToken.data = token[3]
+        self.tokenQueue = []
+
+    def joinPieces(self):
+        # A new list, as a checkpoint may still refer to the old one
+        text = "".join(self.pieces)
+        self.pieces = []
+        return text
 
     def consumeNumberEntity(self, isHex):
         allowed = digits
@@ -152,13 +423,50 @@ class XMLTokenizer(object):
         c = self.stream.char()
         if c != ";":
             # XXX parse error
-            self.stream.queue.append(c)
+            self.stream.unget(c)
         return char
 
-    def consumeEntity(self, fromAttribute=False):
-        # The result of this function is a tuple consisting of the entity
-        # value and whether it needs to be inserted into the stream or
-        # simply appended as character data.
+    def expandEntity(self, depth, length, parameter=False):
+        """Counts the expansion of a reference found at depth into length
+        characters and returns the depth to push them at. If that exceeds
+        one of self.entityLimits the reference is dropped and None returned,
+        or EntityLimitExceeded is raised, depending on the policy."""
+        limits = self.entityLimits
+        stats = self.entityStats
+        characters = stats.characters + length
+        if limits.maxDepth is not None and depth >= limits.maxDepth:
+            limit = "maxDepth"
+        elif limits.maxCharacters is not None and\
+          characters > limits.maxCharacters:
+            limit = "maxCharacters"
+        elif limits.maxRatio is not None and\
+          characters > limits.ratioThreshold and characters >\
+          limits.maxRatio * (self.stream.offset + self.stream.tell):
+            limit = "maxRatio"
+        elif parameter and limits.maxParameterEntities is not None and\
+          stats.parameterEntities >= limits.maxParameterEntities:
+            limit = "maxParameterEntities"
+        else:
+            if parameter:
+                stats.parameterEntities += 1
+            else:
+                stats.entities += 1
+            stats.characters = characters
+            depth += 1
+            if depth > stats.depth:
+                stats.depth = depth
+            return depth
+        if limits.policy == "abort":
+            raise EntityLimitExceeded(limit, stats)
+        stats.dropped += 1
+        return None
+
+    def consumeEntity(self, fromAttribute=False, unquoted=False):
+        # The result of this function is a tuple consisting of whether the
+        # entity value needs to be inserted into the stream or can simply be
+        # appended as character data, the value and, for the former, the
+        # depth to insert it at.
+        depth = self.stream.depth()
         c = self.stream.char()
         if c == "#":
             # Character reference (numeric entity).
@@ -166,15 +474,15 @@ class XMLTokenizer(object):
             c = self.stream.char()
             if c == "x":
                 c = self.stream.char()
-                if c in hexdigits:
+                if c in hexDigits:
                     # Hexadecimal entity detected.
-                    self.stream.queue.insert(0, c)
+                    self.stream.unget(c)
                     value = self.consumeNumberEntity(True)
                 else:
                     value += "x"
             elif c in digits:
                 # Decimal entity detected.
-                self.stream.queue.insert(0, c)
+                self.stream.unget(c)
                 value = self.consumeNumberEntity(False)
             elif c == EOF:
                 # XXX parse error
@@ -200,23 +508,32 @@ class XMLTokenizer(object):
                 end = ""
 
             if name in self.entities:
-                if self.entityCount < 16:
-                    self.entityCount += 1
-                    value = self.entities[name]
-                    if fromAttribute:
-                        # This is a hack to make things "work". Or is it
-                        # really the only good solution?
-                        value = re.sub("\n", "&#10;", value)
-                        value = re.sub("\r", "&#10;", value)
-                        value = re.sub("\t", "&#9;", value)
-                        value = re.sub(" ", "&#32;", value)
-                        value = re.sub("\"", "&#34;", value)
-                        value = re.sub("'", "&#39;", value)
-                    self.entityValueLen += len(value)
-                    return "Stream", value
+                try:
+                    replacement = self.replacements[name]
+                except KeyError:
+                    # Entities can't be redeclared so this never goes stale
+                    replacement = self.replacements[name] =\
+                      Replacement(self.entities[name])
+                if not fromAttribute:
+                    text = replacement.text
+                    value = replacement.content
                 else:
-                    # XXX parse error
-                    return "Characters", ""
+                    # White space and quotes are escaped so they don't end
+                    # the value when it is tokenized again
+                    if unquoted:
+                        text = replacement.unquotedText
+                    else:
+                        text = replacement.attributeText
+                    value = replacement.attribute
+                if text is not None:
+                    if self.expandEntity(depth, len(text)) is not None:
+                        return "Characters", text
+                else:
+                    depth = self.expandEntity(depth, len(value))
+                    if depth is not None:
+                        return "Stream", value, depth
+                # XXX parse error
+                return "Characters", ""
             else:
                 # XXX parse error
                 return "Characters", "&" + name + end
@@ -226,7 +543,7 @@ class XMLTokenizer(object):
         c = self.stream.char()
         value = "&"
         if c == EOF:
-            self.stream.queue.insert(0, c)
+            self.stream.unget(c)
         elif c != "#":
             value += c
         else:
@@ -234,15 +551,15 @@ class XMLTokenizer(object):
             c = self.stream.char()
             if c == "x":
                 c = self.stream.char()
-                if c in hexdigits:
+                if c in hexDigits:
                     # Hexadecimal entity detected.
-                    self.stream.queue.insert(0, c)
+                    self.stream.unget(c)
                     value = self.consumeNumberEntity(True)
                 else:
                     value += "x"
             elif c in digits:
                 # Decimal entity detected.
-                self.stream.queue.insert(0, c)
+                self.stream.unget(c)
                 value = self.consumeNumberEntity(False)
             elif c == EOF:
                 # XXX parse error
@@ -253,36 +570,148 @@ class XMLTokenizer(object):
         return value
 
     def consumeParameterEntity(self):
+        # Pushes the value of the parameter entity back into the stream
+        depth = self.stream.depth()
         name = self.stream.charsUntil(";")
         c = self.stream.char()
         if c != ";":
             # XXX parse error
             pass
 
-        if name in self.parameterEntities and self.entityCount < 16:
-            self.entityCount += 1
+        if name in self.parameterEntities:
             value = self.parameterEntities[name]
-            self.entityValueLen += len(value)
-            return value
-        else:
-            # XXX parse error
-            return ""
+            depth = self.expandEntity(depth, len(value), True)
+            if depth is not None:
+                self.stream.push(value, depth)
+                return
+        # XXX parse error
+
+    def fitsLimits(self, dtd):
+        """Returns whether the parameter entity expansions of dtd fit in
+        self.entityLimits on top of those of the document so far."""
+        limits = self.entityLimits
+        stats = self.entityStats
+        characters = stats.characters + dtd.characters
+        return ((limits.maxDepth is None or dtd.depth <= limits.maxDepth) and
+          (limits.maxCharacters is None or
+          characters <= limits.maxCharacters) and
+          (limits.maxRatio is None or characters <= limits.ratioThreshold or
+          characters <= limits.maxRatio * (self.stream.offset +
+          self.stream.tell)) and
+          (limits.maxParameterEntities is None or stats.parameterEntities +
+          dtd.expandedParameterEntities <= limits.maxParameterEntities))
+
+    def countDTD(self, dtd):
+        stats = self.entityStats
+        stats.parameterEntities += dtd.expandedParameterEntities
+        stats.characters += dtd.characters
+        if dtd.depth > stats.depth:
+            stats.depth = dtd.depth
+
+    def startInternalSubset(self):
+        # Called after the "[". If the same subset was parsed before its
+        # declarations are copied from the cache and it is skipped. Only
+        # the first DOCTYPE of a document is looked up, as the declarations
+        # of another would be mixed with those in the cache.
+        self.state = self.states["doctypeInternalSubset"]
+        self.pendingSubset = None
+        cache = self.dtdCache
+        if cache is None or self.parameterEntities or\
+          self.attributeNormalization or\
+          len(self.entities) != len(predefinedEntities):
+            return
+        text = self.stream.lookahead("]", cache.maxSubsetLength)
+        if text is None:
+            return
+        key = cache.key(text)
+        dtd = cache.get(key)
+        if dtd is None:
+            self.pendingSubset = (key,
+              self.stream.offset + self.stream.tell + len(text),
+              self.entityStats.save())
+        elif self.fitsLimits(dtd):
+            # Copied so the document's own declarations don't end up in
+            # the cache
+            self.entities = dict(dtd.entities)
+            self.parameterEntities = dict(dtd.parameterEntities)
+            self.attributeNormalization = list(dtd.attributeNormalization)
+            self.attributeDefaults = dtd.attributeDefaults
+            self.attributeDefaultsSource = (self.attributeNormalization,
+              len(self.attributeNormalization))
+            self.countDTD(dtd)
+            self.stream.skip(len(text))
+            self.state = self.states["doctypeInternalSubsetAfter"]
 
-    def attributeNameExists(self, name):
-        for x,y in self.currentToken["attributes"]:
-            if x == name:
-                return True
-        return False
+    def endInternalSubset(self):
+        # Called after the "]". The subset is cached if it ended at the
+        # "]" startInternalSubset() found and no expansion in it was dropped
+        # for exceeding a limit.
+        self.state = self.states["doctypeInternalSubsetAfter"]
+        if self.pendingSubset is None:
+            return
+        key, end, saved = self.pendingSubset
+        self.pendingSubset = None
+        stats = self.entityStats
+        if self.stream.frames or stats.dropped != saved[4] or\
+          self.stream.offset + self.stream.tell != end:
+            return
+        self.dtdCache.add(key, DTD(dict(self.entities),
+          dict(self.parameterEntities), list(self.attributeNormalization),
+          stats.parameterEntities - saved[1], stats.characters - saved[2],
+          stats.depth))
+
+    def endDoctype(self):
+        # Called at the ">" of a DOCTYPE. The declarations of the DTD in the
+        # catalog for its system identifier are added to those of the internal
+        # subset, which take precedence.
+        self.state = self.states["data"]
+        if self.dtdCache is None or self.systemIdentifier is None:
+            return
+        dtd = self.dtdCache.lookup(self.systemIdentifier)
+        if dtd is None or not self.fitsLimits(dtd):
+            return
+        entities = dict(dtd.entities)
+        entities.update(self.entities)
+        self.entities = entities
+        parameterEntities = dict(dtd.parameterEntities)
+        parameterEntities.update(self.parameterEntities)
+        self.parameterEntities = parameterEntities
+        self.attributeNormalization = self.attributeNormalization +\
+          dtd.attributeNormalization
+        self.countDTD(dtd)
 
     def emitCurrentToken(self):
-        if (self.currentToken["type"] == "StartTag" or
-          self.currentToken["type"] == "EmptyTag") and\
-          self.attributeNormalization:
-            for token in self.attributeNormalization:
-                if token["name"] == self.currentToken["name"]:
-                    for attr in token["attrs"]:
-                        if attr["dv"] != "" and not self.attributeNameExists(attr["name"]):
-                            self.currentToken["attributes"].append([attr["name"], attr["dv"]])
+        if self.attributeNormalization and\
+          (self.currentToken.kind == tokenTypes["StartTag"] or
+          self.currentToken.kind == tokenTypes["EmptyTag"]):
+            attributeNormalization = self.attributeNormalization
+            compiled, length = self.attributeDefaultsSource
+            if length != len(attributeNormalization) or\
+              compiled is not attributeNormalization:
+                if compiled is attributeNormalization and\
+                  length < len(attributeNormalization):
+                    # Only declarations were added, by another DOCTYPE
+                    self.attributeDefaults = attributeDefaults(
+                      attributeNormalization, length, self.attributeDefaults)
+                else:
+                    self.attributeDefaults = attributeDefaults(
+                      attributeNormalization)
+                self.attributeDefaultsSource = (attributeNormalization,
+                  len(attributeNormalization))
+            defaults = self.attributeDefaults.get(self.currentToken.name)
+            if defaults:
+                attributes = self.currentToken.attributes
+                if attributes:
+                    names = set([name for name, value in attributes])
+                    for name, value in defaults:
+                        if name not in names:
+                            attributes.append([name, value])
+                else:
+                    attributes.extend([[name, value]
+                      for name, value in defaults])
+        if self.currentToken.kind in tagTokenTypes:
+            # So the parser can compare tag names by identity
+            self.currentToken.name = symbols.intern(self.currentToken.name)
         self.tokenQueue.append(self.currentToken)
         self.state = self.states["data"]
 
@@ -306,24 +735,54 @@ class XMLTokenizer(object):
 
     def dataState(self):
         data = self.stream.char()
-        if data == "&":
-            entity = self.consumeEntity()
-            if entity[0] == "Characters":
-                self.tokenQueue.append({"type":"Characters","data":entity[1]})
-            else:
-                i = 0
-                for x in entity[1]:
-                    self.stream.queue.insert(i, x)
-                    i += 1
-        elif data == "<":
+        if data == "<":
             self.state = self.states["tag"]
         elif data == EOF:
             # Tokenization ends.
             return False
         else:
-            chars = self.stream.charsUntil((u"&", u"<", u"\u0000"))
-            self.tokenQueue.append({"type":"Characters","data":data + chars})
-        return True
+            self.consumeText(data)
+        return True
+
+    def consumeText(self, data):
+        # Emits the text that starts with data, up to the next tag, as one
+        # Characters token. Entities in it are expanded into the same token
+        # however deeply they nest, so expansions don't turn into a token
+        # each. In feed mode the text is emitted as far as it was fed.
+        stream = self.stream
+        chars = []
+        while True:
+            if data == "&":
+                # Where the "&" was read, if it came from the document
+                # itself rather than from a pushed back entity value
+                tell = None
+                if not stream.frames:
+                    tell = stream.tell - 1
+                try:
+                    entity = self.consumeEntity()
+                except NeedData:
+                    # The reference is read again once more data is fed
+                    if not chars or tell is None:
+                        raise
+                    stream.tell = tell
+                    break
+                if entity[0] == "Characters":
+                    chars.append(entity[1])
+                else:
+                    stream.push(entity[1], entity[2])
+            else:
+                chars.append(data)
+            chars.append(stream.charsUntil(dataStop))
+            try:
+                data = stream.char()
+            except NeedData:
+                break
+            if data == "<" or data == EOF:
+                stream.unget(data)
+                break
+        text = u"".join(chars)
+        if text:
+            self.tokenQueue.append(Characters(text))
 
     def tagState(self):
         data = self.stream.char()
@@ -339,18 +798,19 @@ class XMLTokenizer(object):
           or data == ":"\
           or data == EOF:
             # XXX parse error
-            self.tokenQueue.append({"type":"Characters", "data":"<"})
-            self.stream.queue.insert(0, data)
+            self.tokenQueue.append(Characters("<"))
+            self.stream.unget(data)
             self.state = self.states["data"]
         else:
-            self.currentToken = {"type":"StartTag", "name":data, "attributes":[]}
+            self.currentToken = Tag(tokenTypes["StartTag"], data, [])
+            self.attributeNames.clear()
             self.state = self.states["tagName"]
         return True
 
     def endTagState(self):
         data = self.stream.char()
         if data == ">":
-            self.tokenQueue.append({"type":"EndTagShort"})
+            self.tokenQueue.append(EndTagShort())
             self.state = self.states["data"]
         elif data in spaceCharacters\
           or data == "<"\
@@ -358,11 +818,11 @@ class XMLTokenizer(object):
           or data == EOF:
             # XXX parse error
             # XXX catch more "incorrect" characters here?
-            self.tokenQueue.append({"type":"Characters", "data":"</"})
-            self.stream.queue.insert(0, data)
+            self.tokenQueue.append(Characters("</"))
+            self.stream.unget(data)
             self.state = self.states["data"]
         else:
-            self.currentToken = {"type":"EndTag", "name":data}
+            self.currentToken = Tag(tokenTypes["EndTag"], data)
             self.state = self.states["endTagName"]
         return True
 
@@ -376,7 +836,8 @@ class XMLTokenizer(object):
         elif data == ">":
             self.emitCurrentToken()
         else:
-            self.currentToken["name"] += data
+            self.currentToken.name += data +\
+              self.stream.charsUntil(endTagNameStop)
         return True
 
     def endTagNameAfterState(self):
@@ -399,11 +860,11 @@ class XMLTokenizer(object):
           or data == EOF:
             # XXX parse error
             # XXX catch more "incorrect" characters here?
-            self.stream.queue.append("?")
-            self.stream.queue.append(data)
+            self.stream.unget(data)
+            self.stream.unget("?")
             self.state = self.states["bogusComment"]
         else:
-            self.currentToken = {"type":"Pi", "name":data, "data":""}
+            self.currentToken = Pi(data, "")
             self.state = self.states["piTarget"]
         return True
 
@@ -418,7 +879,8 @@ class XMLTokenizer(object):
         elif data == "?":
             self.state = self.states["piAfter"]
         else:
-            self.currentToken["name"] += data
+            self.currentToken.name += data +\
+              self.stream.charsUntil(piTargetStop)
         return True
 
     def piTargetAfterState(self):
@@ -426,7 +888,7 @@ class XMLTokenizer(object):
         if data in spaceCharacters:
             pass
         else:
-            self.stream.queue.append(data)
+            self.stream.unget(data)
             self.state = self.states["piContent"]
         return True
 
@@ -436,19 +898,22 @@ class XMLTokenizer(object):
             self.state = self.states["piAfter"]
         elif data == EOF:
             # XXX parse error
+            self.currentToken.data += self.joinPieces()
             self.emitCurrentToken()
         else:
-            self.currentToken["data"] += data
+            self.pieces.append(data)
+            self.pieces.append(self.stream.charsUntil(u"?"))
         return True
 
     def piAfterState(self):
         data = self.stream.char()
         if data == ">":
+            self.currentToken.data += self.joinPieces()
             self.emitCurrentToken()
         elif data == "?":
-            self.currentToken["data"] += "?"
+            self.pieces.append("?")
         else:
-            self.stream.queue.append(data)
+            self.stream.unget(data)
             self.state = self.states["piContent"]
         return True
 
@@ -456,7 +921,7 @@ class XMLTokenizer(object):
     def markupDeclarationState(self):
         charStack = [self.stream.char(), self.stream.char()]
         if charStack == ["-", "-"]:
-            self.currentToken = {"type":"Comment", "data":""}
+            self.currentToken = Comment("")
             self.state = self.states["comment"]
         else:
             for x in xrange(5):
@@ -471,7 +936,8 @@ class XMLTokenizer(object):
                     self.state = self.states["doctype"]
                     return True
             # XXX parse error
-            self.stream.queue.extend(charStack)
+            for c in reversed(charStack):
+                self.stream.unget(c)
             self.state = self.states["bogusComment"]
         return True
 
@@ -482,10 +948,12 @@ class XMLTokenizer(object):
             self.state = self.states["commentDash"]
         elif data == EOF:
             # XXX parse error
+            self.currentToken.data += self.joinPieces()
             self.tokenQueue.append(self.currentToken)
             self.state = self.states["data"]
         else:
-            self.currentToken["data"] += data + self.stream.charsUntil("-")
+            self.pieces.append(data)
+            self.pieces.append(self.stream.charsUntil("-"))
         return True
 
     def commentDashState(self):
@@ -494,11 +962,12 @@ class XMLTokenizer(object):
             self.state = self.states["commentEnd"]
         elif data == EOF:
             # XXX parse error
+            self.currentToken.data += self.joinPieces()
             self.tokenQueue.append(self.currentToken)
             self.state = self.states["data"]
         else:
-            self.currentToken["data"] += "-" + data +\
-              self.stream.charsUntil("-")
+            self.pieces.append("-" + data)
+            self.pieces.append(self.stream.charsUntil("-"))
             # Consume the next character which is either a "-" or an EOF as
             # well so if there's a "-" directly after the "-" we go nicely to
             # the "comment end state" without emitting a ParseError() there.
@@ -508,16 +977,18 @@ class XMLTokenizer(object):
     def commentEndState(self):
         data = self.stream.char()
         if data == ">":
+            self.currentToken.data += self.joinPieces()
             self.tokenQueue.append(self.currentToken)
             self.state = self.states["data"]
         elif data == "-":
-            self.currentToken["data"] += "-"
+            self.pieces.append("-")
         elif data == EOF:
             # XXX parse error
+            self.currentToken.data += self.joinPieces()
             self.tokenQueue.append(self.currentToken)
             self.state = self.states["data"]
         else:
-            self.currentToken["data"] += "--" + data
+            self.pieces.append("--" + data)
             self.state = self.states["comment"]
         return True
 
@@ -530,8 +1001,8 @@ class XMLTokenizer(object):
             # XXX parse error
             self.state = self.states["data"]
         else:
-            self.tokenQueue.append({"type":"Characters", "data":\
-              data + self.stream.charsUntil("]")})
+            self.tokenQueue.append(Characters(
+              data + self.stream.charsUntil("]")))
         return True
 
     def cdataBracketState(self):
@@ -542,8 +1013,8 @@ class XMLTokenizer(object):
             # XXX parse error
             self.state = self.states["data"]
         else:
-            self.tokenQueue.append({"type":"Characters", "data":\
-              "]" + data + self.stream.charsUntil("]")})
+            self.tokenQueue.append(Characters(
+              "]" + data + self.stream.charsUntil("]")))
             # Consume the next character which is either a "]" or an EOF as
             # well so if there's a "]" directly after the "]" we go nicely to
             # the "cdata end state" without emitting a ParseError() there.
@@ -555,12 +1026,12 @@ class XMLTokenizer(object):
         if data == ">":
             self.state = self.states["data"]
         elif data == "]":
-            self.tokenQueue.append({"type":"Characters", "data":data})
+            self.tokenQueue.append(Characters(data))
         elif data == EOF:
             # XXX parse error
             self.state = self.states["data"]
         else:
-            self.tokenQueue.append({"type":"Characters", "data":"]]" + data})
+            self.tokenQueue.append(Characters("]]" + data))
             self.state = self.states["cdata"]
         return True
 
@@ -568,12 +1039,15 @@ class XMLTokenizer(object):
     def doctypeState(self):
         data = self.stream.char()
         if data in spaceCharacters:
+            self.publicIdentifier = self.systemIdentifier = None
+            self.doctypeKeyword = None
+            self.doctypeLiterals = []
             self.state = self.states["doctypeRootNameBefore"]
         elif data == EOF:
             # XXX parse error?
             self.state = self.states["data"]
         else:
-            self.stream.queue.append(data)
+            self.stream.unget(data)
             self.state = self.states["bogusComment"]
         return True
 
@@ -597,51 +1071,70 @@ class XMLTokenizer(object):
         elif data == ">":
             self.state = self.states["data"]
         elif data == "[":
-            self.state = self.states["doctypeInternalSubset"]
+            self.startInternalSubset()
         elif data == EOF:
             # XXX parse error?
             self.state = self.states["data"]
         else:
-            pass
+            self.stream.charsUntil(doctypeRootNameStop)
         return True
 
     def doctypeRootNameAfterState(self):
         data = self.stream.char()
         if data == ">":
-            self.state = self.states["data"]
+            self.endDoctype()
         elif data == "\"":
+            self.doctypeLiterals.append(u"")
             self.state = self.states["doctypeIdentifierDoubleQuoted"]
         elif data == "'":
+            self.doctypeLiterals.append(u"")
             self.state = self.states["doctypeIdentifierSingleQuoted"]
         elif data == "[":
-            self.state = self.states["doctypeInternalSubset"]
+            self.startInternalSubset()
         elif data == EOF:
             # XXX parse error?
             self.state = self.states["data"]
         else:
-            pass
-        return True
+            words = (data +
+              self.stream.charsUntil(doctypeIdentifierStop)).split()
+            if words and not self.doctypeLiterals:
+                self.doctypeKeyword = words[-1].upper()
+        return True
+
+    def endDoctypeLiteral(self):
+        # Called at the quote that ends a literal. PUBLIC is followed by the
+        # public and then the system identifier, SYSTEM by the system
+        # identifier alone.
+        self.state = self.states["doctypeRootNameAfter"]
+        literals = self.doctypeLiterals
+        if self.doctypeKeyword == "PUBLIC":
+            if len(literals) == 1:
+                self.publicIdentifier = literals[0]
+            elif len(literals) == 2:
+                self.systemIdentifier = literals[1]
+        elif self.doctypeKeyword == "SYSTEM" and len(literals) == 1:
+            self.systemIdentifier = literals[0]
 
     def doctypeIdentifierDoubleQuotedState(self):
         data = self.stream.char()
         if data == "\"":
-            self.state = self.states["doctypeRootNameAfter"]
+            self.endDoctypeLiteral()
         elif data == EOF:
             # XXX parse error?
             self.state = self.states["data"]
         else:
-            pass
+            self.doctypeLiterals[-1] += data + self.stream.charsUntil(u"\"")
         return True
 
     def doctypeIdentifierSingleQuotedState(self):
         data = self.stream.char()
         if data == "'":
-            self.state = self.states["doctypeRootNameAfter"]
+            self.endDoctypeLiteral()
         elif data == EOF:
             # XXX parse error?
             self.state = self.states["data"]
         else:
-            pass
+            self.doctypeLiterals[-1] += data + self.stream.charsUntil(u"'")
         return True
 
     def doctypeInternalSubsetState(self):
@@ -652,17 +1145,17 @@ class XMLTokenizer(object):
             # XXX parse error
             self.state = self.states["data"]
         elif data == "%":
-            self.stream.queue.extend(self.consumeParameterEntity())
+            self.consumeParameterEntity()
         elif data == "]":
-            self.state = self.states["doctypeInternalSubsetAfter"]
+            self.endInternalSubset()
         else:
-            pass
+            self.stream.charsUntil(doctypeInternalSubsetStop)
         return True
 
     def doctypeInternalSubsetAfterState(self):
         data = self.stream.char()
         if data == ">":
-            self.state = self.states["data"]
+            self.endDoctype()
         elif data == EOF:
             # XXX parse error
             self.state = self.states["data"]
@@ -707,7 +1200,8 @@ class XMLTokenizer(object):
                             self.state = self.states["doctypeNotation"]
                             return True
             # XXX parse error
-            self.stream.queue.extend(charStack)
+            for c in reversed(charStack):
+                self.stream.unget(c)
             self.state = self.states["doctypeBogusComment"]
         return True
 
@@ -720,7 +1214,7 @@ class XMLTokenizer(object):
             # XXX parse error
             self.state = self.states["data"]
         else:
-            pass
+            self.stream.charsUntil(u"-")
         return True
 
     def doctypeCommentDashState(self):
@@ -806,7 +1300,8 @@ class XMLTokenizer(object):
             self.currentToken = None
             self.state = self.states["data"]
         else:
-            self.currentToken["name"] += data
+            self.currentToken["name"] += data +\
+              self.stream.charsUntil(spaceCharacters)
         return True
 
     def doctypeEntityNameAfterState(self):
@@ -837,7 +1332,8 @@ class XMLTokenizer(object):
             self.currentToken == None
             self.state = self.states["data"]
         else:
-            self.currentToken["value"] += data
+            self.currentToken["value"] += data +\
+              self.stream.charsUntil((u"\"", u"&"))
         return True
 
     def doctypeEntityValSingleQuotedState(self):
@@ -852,7 +1348,8 @@ class XMLTokenizer(object):
             self.currentToken == None
             self.state = self.states["data"]
         else:
-            self.currentToken["value"] += data
+            self.currentToken["value"] += data +\
+              self.stream.charsUntil((u"'", u"&"))
         return True
 
     def doctypeEntityValAfterState(self):
@@ -882,7 +1379,7 @@ class XMLTokenizer(object):
             self.currentToken = None
             self.state = self.states["data"]
         else:
-            pass
+            self.stream.charsUntil(doctypeEntityIdentifierStop)
         return True
 
     def doctypeEntityIdentifierDoubleQuotedState(self):
@@ -894,7 +1391,7 @@ class XMLTokenizer(object):
             self.currentToken = None
             self.state = self.states["data"]
         else:
-            pass
+            self.stream.charsUntil(u"\"")
         return True
 
     def doctypeEntityIdentifierSingleQuotedState(self):
@@ -906,7 +1403,7 @@ class XMLTokenizer(object):
             self.currentToken = None
             self.state = self.states["data"]
         else:
-            pass
+            self.stream.charsUntil(u"'")
         return True
 
     def doctypeAttlistState(self):
@@ -940,7 +1437,8 @@ class XMLTokenizer(object):
             # XXX parse error
             self.state = self.states["data"]
         else:
-            self.attributeNormalization[-1]["name"] += data
+            self.attributeNormalization[-1]["name"] += data +\
+              self.stream.charsUntil(spaceCharacters)
         return True
 
     def doctypeAttlistNameAfterState(self):
@@ -965,7 +1463,8 @@ class XMLTokenizer(object):
             # XXX parse error
             self.state = self.states["data"]
         else:
-            self.attributeNormalization[-1]["attrs"][-1]["name"] += data
+            self.attributeNormalization[-1]["attrs"][-1]["name"] += data +\
+              self.stream.charsUntil(spaceCharacters)
         return True
 
     def doctypeAttlistAttrnameAfterState(self):
@@ -988,7 +1487,8 @@ class XMLTokenizer(object):
             # XXX parse error
             self.state = self.states["data"]
         else:
-            self.attributeNormalization[-1]["attrs"][-1]["type"] += data
+            self.attributeNormalization[-1]["attrs"][-1]["type"] += data +\
+              self.stream.charsUntil(spaceCharacters)
         return True
 
     def doctypeAttlistAttrtypeAfterState(self):
@@ -1023,7 +1523,7 @@ class XMLTokenizer(object):
             # XXX parse error
             self.state = self.states["data"]
         else:
-            pass
+            self.stream.charsUntil(spaceCharacters)
         return True
 
     def doctypeAttlistAttrdeclAfterState(self):
@@ -1053,7 +1553,8 @@ class XMLTokenizer(object):
         elif data == "&":
             raise NotSupportedError
         else:
-            self.attributeNormalization[-1]["attrs"][-1]["dv"] += data
+            self.attributeNormalization[-1]["attrs"][-1]["dv"] += data +\
+              self.stream.charsUntil((u"\"", u"%", u"&"))
         return True
 
     def doctypeAttlistAttrvalSingleQuotedState(self):
@@ -1065,7 +1566,8 @@ class XMLTokenizer(object):
         elif data == "&":
             raise NotSupportedError
         else:
-            self.attributeNormalization[-1]["attrs"][-1]["dv"] += data
+            self.attributeNormalization[-1]["attrs"][-1]["dv"] += data +\
+              self.stream.charsUntil((u"'", u"%", u"&"))
         return True
 
     # <!NOTATION
@@ -1092,7 +1594,7 @@ class XMLTokenizer(object):
             # XXX parse error
             self.state = self.states["data"]
         else:
-            pass
+            self.stream.charsUntil(doctypeEntityIdentifierStop)
         return True
 
     def doctypeNotationIdentifierDoubleQuotedState(self):
@@ -1103,7 +1605,7 @@ class XMLTokenizer(object):
             # XXX parse error
             self.state = self.states["data"]
         else:
-            pass
+            self.stream.charsUntil(u"\"")
         return True
 
     def doctypeNotationIdentifierSingleQuotedState(self):
@@ -1114,7 +1616,7 @@ class XMLTokenizer(object):
             # XXX parse error
             self.state = self.states["data"]
         else:
-            pass
+            self.stream.charsUntil(u"'")
         return True
 
     def doctypePiState(self):
@@ -1125,7 +1627,7 @@ class XMLTokenizer(object):
             # XXX parse error
             self.state = self.states["data"]
         else:
-            pass
+            self.stream.charsUntil(u"?")
         return True
 
     def doctypePiAfterState(self):
@@ -1161,17 +1663,18 @@ class XMLTokenizer(object):
         elif data == "/":
             self.state = self.states["emptyTag"]
         else:
-            self.currentToken["name"] += data
+            self.currentToken.name += data +\
+              self.stream.charsUntil(tagNameStop)
         return True
 
     def emptyTagState(self):
         data = self.stream.char()
         if data == ">":
-            self.currentToken["type"] = "EmptyTag"
+            self.currentToken.kind = tokenTypes["EmptyTag"]
             self.emitCurrentToken()
         else:
             # XXX parse error
-            self.stream.queue.insert(0, data)
+            self.stream.unget(data)
             self.state = self.states["tagAttributeNameBefore"]
         return True
 
@@ -1190,7 +1693,7 @@ class XMLTokenizer(object):
             # XXX parse error
             self.emitCurrentToken()
         else:
-            self.currentToken["attributes"].append([data, ""])
+            self.currentToken.attributes.append([data, ""])
             self.state = self.states["tagAttributeName"]
         return True
 
@@ -1211,17 +1714,20 @@ class XMLTokenizer(object):
             self.emitCurrentToken()
             leavingThisState = False
         else:
-            self.currentToken["attributes"][-1][0] += data
+            self.currentToken.attributes[-1][0] += data +\
+              self.stream.charsUntil(attributeNameStop)
             leavingThisState = False
 
         if leavingThisState:
             # Attributes are not dropped at this stage. That happens when the
             # start tag token is emitted so values can still be safely appended
             # to attributes, but we do want to report the parse error in time.
-            for name, value in self.currentToken["attributes"][:-1]:
-                if self.currentToken["attributes"][-1][0] == name:
-                    # XXX parse error
-                    pass
+            name = self.currentToken.attributes[-1][0]
+            if name in self.attributeNames:
+                # XXX parse error
+                pass
+            else:
+                self.attributeNames.add(name)
             if data == ">":
                 self.emitCurrentToken()
         return True
@@ -1243,7 +1749,7 @@ class XMLTokenizer(object):
             # XXX parse error
             self.emitCurrentToken()
         else:
-            self.currentToken["attributes"].append([data, ""])
+            self.currentToken.attributes.append([data, ""])
             self.state = self.states["tagAttributeName"]
         return True
 
@@ -1256,7 +1762,7 @@ class XMLTokenizer(object):
         elif data == "'":
             self.state = self.states["tagAttributeValueSingleQuoted"]
         elif data == "&":
-            self.stream.queue.append(data);
+            self.stream.unget(data)
             self.state = self.states["tagAttributeValueUnquoted"]
         elif data == ">":
             self.emitCurrentToken()
@@ -1264,78 +1770,77 @@ class XMLTokenizer(object):
             # XXX parse error
             self.emitCurrentToken()
         else:
-            self.currentToken["attributes"][-1][1] += data
+            self.currentToken.attributes[-1][1] += data
             self.state = self.states["tagAttributeValueUnquoted"]
         return True
 
     def tagAttributeValueDoubleQuotedState(self):
         data = self.stream.char()
         if data == "\"":
+            self.currentToken.attributes[-1][1] += self.joinPieces()
             self.state = self.states["tagAttributeNameBefore"]
         elif data == "&":
             entity = self.consumeEntity(True)
             if entity[0] == "Characters":
-                self.currentToken["attributes"][-1][1] += entity[1]
+                self.pieces.append(entity[1])
             else:
-                i = 0
-                for x in entity[1]:
-                    self.stream.queue.insert(i, x)
-                    i += 1
+                self.stream.push(entity[1], entity[2])
         elif data == EOF:
             # XXX parse error
+            self.currentToken.attributes[-1][1] += self.joinPieces()
             self.emitCurrentToken()
         else:
-            self.currentToken["attributes"][-1][1] += data +\
-              self.stream.charsUntil(("\"", "&"))
+            self.pieces.append(data)
+            self.pieces.append(self.stream.charsUntil(("\"", "&")))
         return True
 
     def tagAttributeValueSingleQuotedState(self):
         data = self.stream.char()
         if data == "'":
+            self.currentToken.attributes[-1][1] += self.joinPieces()
             self.state = self.states["tagAttributeNameBefore"]
         elif data == "&":
             entity = self.consumeEntity(True)
             if entity[0] == "Characters":
-                self.currentToken["attributes"][-1][1] += entity[1]
+                self.pieces.append(entity[1])
             else:
-                i = 0
-                for x in entity[1]:
-                    self.stream.queue.insert(i, x)
-                    i += 1
+                self.stream.push(entity[1], entity[2])
         elif data == EOF:
             # XXX parse error
+            self.currentToken.attributes[-1][1] += self.joinPieces()
             self.emitCurrentToken()
         else:
-            self.currentToken["attributes"][-1][1] += data +\
-              self.stream.charsUntil(("'", "&"))
+            self.pieces.append(data)
+            self.pieces.append(self.stream.charsUntil(("'", "&")))
         return True
 
     def tagAttributeValueUnquotedState(self):
         data = self.stream.char()
         if data in spaceCharacters:
+            self.currentToken.attributes[-1][1] += self.joinPieces()
             self.state = self.states["tagAttributeNameBefore"]
         elif data == "&":
-            entity = self.consumeEntity(True)
+            entity = self.consumeEntity(True, True)
             if entity[0] == "Characters":
-                self.currentToken["attributes"][-1][1] += entity[1]
+                self.pieces.append(entity[1])
             else:
-                i = 0
-                for x in entity[1]:
-                    self.stream.queue.insert(i, x)
-                    i += 1
+                self.stream.push(entity[1], entity[2])
         elif data == ">":
+            self.currentToken.attributes[-1][1] += self.joinPieces()
             self.emitCurrentToken()
         elif data == EOF:
             # XXX parse error
+            self.currentToken.attributes[-1][1] += self.joinPieces()
             self.emitCurrentToken()
         else:
-            self.currentToken["attributes"][-1][1] += data +\
-              self.stream.charsUntil(frozenset(("&", ">","<")) | spaceCharacters)
+            self.pieces.append(data)
+            self.pieces.append(
+              self.stream.charsUntil(attributeValueUnquotedStop))
         return True
 
     # Consume everything up and including > and make it a comment.
     def bogusCommentState(self):
-        self.tokenQueue.append({"type": "Comment", "data": self.stream.charsUntil(">")})
+        self.tokenQueue.append(Comment(self.stream.charsUntil(">")))
         self.stream.char()
         self.state = self.states["data"]
         return True
@@ -30,6 +30,9 @@ It also has one required method:
 The supplied simpletree module provides a python-only implementation
 of a full treebuilder and is a useful reference for the semantics of
 the various methods.
+
+The sax module doesn't build a tree at all but passes the document to a
+ContentHandler as it is parsed.
 """
 
 import os.path
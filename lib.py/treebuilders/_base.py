@@ -1,4 +1,16 @@
+from __future__ import absolute_import
+# Imported absolutely so there is one symbol table, not another one under
+# treebuilders.symbols
+from symbols import symbols
+
 class Node(object):
+    # Implementations may use __slots__ for their nodes
+    __slots__ = ()
+
+    # (start, end) in the source, each a (line, col, offset) tuple, when the
+    # parser tracks positions
+    span = None
+
     def __init__(self, name):
         """Node representing an item in the tree.
         parent - The parent of the current node (or None for the document node)
@@ -15,12 +27,71 @@ class Node(object):
         """
         raise NotImplementedError
 
+    def removeChild(self, node):
+        """Remove node from the children of the current node
+        """
+        raise NotImplementedError
+
+    def clear(self):
+        """Remove all children of the current node
+        """
+        raise NotImplementedError
+
     def insertText(self, data, insertBefore=None):
         """Insert data as text in the current node, positioned before the 
         start of node insertBefore or to the end of the node's text.
         """
         raise NotImplementedError
 
+class Attribute(object):
+    """An attribute of an element. For compatibility it can also be used as
+    the dictionary attributes used to be, as in attribute["value"], with
+    the keys name, localname, prefix, namespace and value."""
+    __slots__ = ("name", "localname", "prefix", "namespace", "value")
+
+    def __init__(self, name, localname, prefix, namespace, value):
+        self.name = name
+        self.localname = localname
+        self.prefix = prefix
+        self.namespace = namespace
+        self.value = value
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def get(self, key, default=None):
+        if key not in self.__slots__:
+            return default
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        return key in self.__slots__
+
+    def __iter__(self):
+        return iter(self.__slots__)
+
+    def __len__(self):
+        return len(self.__slots__)
+
+    def keys(self):
+        return list(self.__slots__)
+
+    def values(self):
+        return [getattr(self, key) for key in self.__slots__]
+
+    def items(self):
+        return [(key, getattr(self, key)) for key in self.__slots__]
+
+    def __repr__(self):
+        return "<Attribute %s=%r>" % (self.name, self.value)
+
 class TreeBuilder(object):
     """Base treebuilder implementation
     """
@@ -37,123 +108,137 @@ class TreeBuilder(object):
         self.openElements = []
         self.document = self.documentClass()
 
-    def findDefaultNamespaceInAttributes(self, attributes):
-        for name,value in attributes:
-            if name == "xmlns":
-                return value
-        return None
-
-    def findDefaultNamespaceInAttributeTokens(self, attributes):
-        for token in attributes:
-            if token["name"] == "xmlns":
-                return token["value"]
-        return None
-
-    def findNamespaceInAttributes(self, attributes, prefix):
-        for name,value in attributes:
-            if name == "".join(["xmlns:",prefix]):
-                return value
-        return None
-
-    def findNamespaceInAttributeTokens(self, attributes, prefix):
+        # The namespace scope of each open element, with the empty scope of
+        # the document at the bottom. A scope maps prefixes, "" for the
+        # default namespace, to namespace names. Elements without namespace
+        # declarations share the scope of their parent.
+        self.namespaceScopes = [{}]
+
+    def declareNamespaces(self, attributes):
+        """Returns the scope of an element with the given [name, value]
+        attributes: the scope of the current node plus the element's own
+        xmlns declarations. Only the first declaration of a prefix counts
+        and one with an empty value doesn't change the scope."""
+        scope = self.namespaceScopes[-1]
         if attributes:
-            for token in attributes:
-                if token["name"] == "".join(["xmlns:",prefix]):
-                    return token["value"]
-        return None
+            parent = scope
+            declared = None
+            for name, value in attributes:
+                if name == "xmlns":
+                    prefix = ""
+                elif name.startswith("xmlns:") and len(name) > 6:
+                    prefix = name[6:]
+                else:
+                    # Including a bare "xmlns:", which declares nothing
+                    continue
+                if declared is None:
+                    declared = set()
+                elif prefix in declared:
+                    continue
+                declared.add(prefix)
+                if value:
+                    if scope is parent:
+                        scope = parent.copy()
+                    scope[prefix] = symbols.intern(value)
+        return scope
 
     def findDefaultNamespace(self):
-        tempNamespace = None
-        for node in self.openElements[::-1]:
-            if node.attributes:
-                tempNamespace = self.findDefaultNamespaceInAttributeTokens(node.attributes)
-                if tempNamespace:
-                    return tempNamespace
-        return ""
+        return self.namespaceScopes[-1].get("", "")
 
     def findNamespace(self, prefix):
-        tempNamespace = None
-        for node in self.openElements[::-1]:
-            if node.attributes:
-                tempNamespace = self.findNamespaceInAttributeTokens(node.attributes, prefix)
-                if tempNamespace:
-                    return tempNamespace
-        return ""
-    
-    def findElementNamespace(self, prefix, attributes):
-        namespace = None
-        if prefix == "":
-            if attributes:
-                namespace = self.findDefaultNamespaceInAttributes(attributes)
-            if not namespace:
-                namespace = self.findDefaultNamespace()
-        else:
-            if attributes:
-                namespace = self.findNamespaceInAttributes(attributes, prefix)
-            if not namespace:
-                namespace = self.findNamespace(prefix)
-        return namespace
+        return self.namespaceScopes[-1].get(prefix, "")
 
-    def createAttributeList(self, attributes):
+    def createAttributeList(self, attributes, scope):
         newAttributeList = []
+        seen = set()
         for name,value in attributes:
-            prefix, localname, tempNamespace = ("", name, None)
-            if name.find(":") != -1:
-                prefix, localname = name.split(":", 1)
-            token = {"name":name, "localname":localname, "prefix":prefix, "namespace":"", "value":value}
+            name, prefix, localname = symbols.qualifiedName(name)
+            namespace = ""
             if name == "xmlns" or prefix == "xmlns":
-                token["namespace"] = "http://www.w3.org/2000/xmlns/"
+                namespace = "http://www.w3.org/2000/xmlns/"
             elif prefix == "xml":
-                token["namespace"] = "http://www.w3.org/XML/1998/namespace"
+                namespace = "http://www.w3.org/XML/1998/namespace"
             elif prefix != "":
-                if attributes:
-                    tempNamespace = self.findNamespaceInAttributes(attributes, prefix)
-                if not tempNamespace:
-                    tempNamespace = self.findNamespace(prefix)
-                token["namespace"] = tempNamespace
+                namespace = scope.get(prefix, "")
 
             # Remove duplicate attributes
-            duplicate = False
-            for item in newAttributeList:
-                if item["localname"] == token["localname"] and\
-                  item["namespace"] == token["namespace"]:
-                    # XXX parse error
-                    duplicate = True
-                    break
-            if not duplicate:
-                newAttributeList.append(token)
+            key = (namespace, localname)
+            if key in seen:
+                # XXX parse error
+                pass
+            else:
+                seen.add(key)
+                newAttributeList.append(Attribute(name, localname, prefix,
+                  namespace, symbols.internValue(value)))
         return newAttributeList
 
-    def createElement(self, name, attributes):
-        prefix = ""
-        localname = name
-        if name.find(":") != -1:
-            prefix, localname = name.split(":", 1)
+    def createElement(self, name, attributes, scope=None):
+        """Creates an element with the given [name, value] attributes.
+        scope is the namespace scope of the element, see
+        declareNamespaces()."""
+        if scope is None:
+            scope = self.declareNamespaces(attributes)
+        name, prefix, localname = symbols.qualifiedName(name)
         if prefix == "xmlns":
             namespace = "http://www.w3.org/2000/xmlns/"
         elif prefix == "xml":
             namespace = "http://www.w3.org/XML/1998/namespace"
         else:
-            namespace = self.findElementNamespace(prefix, attributes)
+            namespace = scope.get(prefix, "")
         if attributes:
-            attributes = self.createAttributeList(attributes)
+            attributes = self.createAttributeList(attributes, scope)
         return self.elementClass(name, prefix, localname, namespace, attributes)
 
     def elementInScope(self, target):
-        if self.openElements[-1].name == target:
-            return True
-
-        # AT Use reverse instead of [::-1] when we can rely on Python 2.4
-        for node in self.openElements[::-1][1:]:
-            if node.name == target:
+        # Names are compared by identity first as they usually come from
+        # the symbol table
+        for node in reversed(self.openElements):
+            if node.name is target or node.name == target:
                 return True
         return False
 
+    def currentNode(self):
+        """The node new nodes are appended to."""
+        if self.openElements:
+            return self.openElements[-1]
+        return self.document
+
+    def insertElement(self, name, attributes):
+        """Creates an element, appends it to the current node and makes it
+        the current node."""
+        scope = self.declareNamespaces(attributes)
+        element = self.createElement(name, attributes, scope)
+        self.currentNode().appendChild(element)
+        self.openElements.append(element)
+        self.namespaceScopes.append(scope)
+        return element
+
+    def popElement(self):
+        """Closes the current node."""
+        self.namespaceScopes.pop()
+        return self.openElements.pop()
+
+    def insertComment(self, data):
+        comment = self.commentClass(data)
+        self.currentNode().appendChild(comment)
+        return comment
+
+    def insertPi(self, name, data):
+        pi = self.piClass(name, data)
+        self.currentNode().appendChild(pi)
+        return pi
+
     def insertText(self, data, parent=None):
-        """Insert text data."""
+        """Insert text data. Returns the node holding the text, if the tree
+        has one."""
         if parent is None:
             parent = self.openElements[-1]
-        parent.insertText(data)
+        return parent.insertText(data)
+
+    def endDocument(self):
+        """Called after the last token. Elements that were not closed are
+        left as they are."""
+        pass
 
     def getDocument(self):
         "Return the final tree"
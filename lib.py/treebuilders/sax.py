@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+"""Reports a document as a series of events instead of building a tree.
+
+The events come from the same parser phases as the trees do, so end tags
+that are implied by </> or a mismatched end tag, or left open at the end
+of the document, still produce endElement calls.
+
+  class Titles(ContentHandler):
+      def startElement(self, name, prefix, localname, namespace, attributes):
+          ...
+
+  sax.parse(open("feed.xml"), Titles())
+
+Only the open elements are kept in memory, as namespace declarations have
+to be looked up in them.
+"""
+from __future__ import absolute_import
+# Imported absolutely so the parser is the one in the parent directory, with
+# its symbol table and DTD cache, not a copy under treebuilders.parser
+from parser import XMLParser
+from treebuilders import _base
+from treebuilders import simpletree
+
+class ContentHandler(object):
+    """Receives the events of a document. The methods do nothing; override
+    the ones that are of interest."""
+
+    def startElement(self, name, prefix, localname, namespace, attributes):
+        """attributes is a list of _base.Attribute objects, with name,
+        prefix, localname, namespace and value, in source order."""
+        pass
+
+    def endElement(self, name, prefix, localname, namespace):
+        pass
+
+    def characters(self, data):
+        """Text content. Adjacent text may be reported in several calls."""
+        pass
+
+    def comment(self, data):
+        pass
+
+    def processingInstruction(self, target, data):
+        pass
+
+    def endDocument(self):
+        pass
+
+class TreeBuilder(_base.TreeBuilder):
+    elementClass = simpletree.Element
+    piClass = simpletree.Pi
+    commentClass = simpletree.Comment
+
+    def __init__(self, handler=None):
+        if handler is None:
+            handler = ContentHandler()
+        self.handler = handler
+        _base.TreeBuilder.__init__(self)
+
+    def reset(self):
+        self.openElements = []
+        self.document = None
+        self.namespaceScopes = [{}]
+
+    def insertElement(self, name, attributes):
+        # Elements are not appended to their parent, so they go away when
+        # they are popped.
+        scope = self.declareNamespaces(attributes)
+        element = self.createElement(name, attributes, scope)
+        self.handler.startElement(element.name, element.prefix,
+          element.localname, element.namespace, element.attributes)
+        self.openElements.append(element)
+        self.namespaceScopes.append(scope)
+        return element
+
+    def popElement(self):
+        self.namespaceScopes.pop()
+        element = self.openElements.pop()
+        self.handler.endElement(element.name, element.prefix,
+          element.localname, element.namespace)
+        return element
+
+    def insertComment(self, data):
+        self.handler.comment(data)
+        return self.commentClass(data)
+
+    def insertPi(self, name, data):
+        self.handler.processingInstruction(name, data)
+        return self.piClass(name, data)
+
+    def insertText(self, data, parent=None):
+        self.handler.characters(data)
+        return None
+
+    def endDocument(self):
+        while self.openElements:
+            self.popElement()
+        self.handler.endDocument()
+
+    def getDocument(self):
+        return None
+
+def createParser(handler):
+    """Returns an XMLParser that reports to handler. Its parse() and close()
+    return None."""
+    return XMLParser(tree=lambda: TreeBuilder(handler))
+
+def parse(source, handler, encoding=None):
+    """Parses source, a file-object, local filename or string, reporting
+    the document to handler."""
+    createParser(handler).parse(source, encoding)
@@ -1,86 +1,229 @@
 #!/usr/bin/env python
-import _base
-from xml.sax.saxutils import escape
+from __future__ import absolute_import
+# Imported absolutely so there is one serializer module, not another one
+# under treebuilders.serializer
+import serializer
+from treebuilders import _base
+
+# Attributes whose value identifies an element for getElementById
+idAttributes = frozenset(("id", "xml:id"))
 
 # DOM-core like implementation with extensions.
 class Node(_base.Node):
+    # Nodes are slotted to keep large documents small. Only documents and
+    # elements have a list of children; the other nodes share an empty
+    # tuple.
+    __slots__ = ("parent", "span")
+
     def __init__(self):
-        self.childNodes = []
+        self.parent = None
+        self.span = None
 
     def __iter__(self):
-        for node in self.childNodes:
+        return self.preOrder()
+
+    def preOrder(self):
+        """Yields the descendants of the node, each before its children."""
+        stack = self.childNodes[::-1]
+        while stack:
+            node = stack.pop()
             yield node
-            for item in node:
-                yield item
+            if node.childNodes:
+                stack.extend(node.childNodes[::-1])
+
+    def postOrder(self):
+        """Yields the descendants of the node, each after its children."""
+        stack = [(node, False) for node in self.childNodes[::-1]]
+        while stack:
+            node, visited = stack.pop()
+            if visited or not node.childNodes:
+                yield node
+            else:
+                stack.append((node, True))
+                stack.extend([(child, False)
+                  for child in node.childNodes[::-1]])
+
+    def getElementsByTagName(self, name):
+        """Returns the descendant elements called name in document order."""
+        return [node for node in self
+          if node.nodeType == serializer.ELEMENT_NODE and node.name == name]
+
+    def getElementsByTagNameNS(self, namespace, localname):
+        if namespace is None:
+            namespace = ""
+        return [node for node in self
+          if node.nodeType == serializer.ELEMENT_NODE and
+          node.localname == localname and node.namespace == namespace]
+
+    def getElementById(self, id):
+        """Returns the first descendant element with an id or xml:id
+        attribute of id, or None."""
+        for node in self:
+            if node.nodeType == serializer.ELEMENT_NODE and node.attributes:
+                for attribute in node.attributes:
+                    if attribute.name in idAttributes and\
+                      attribute.value == id:
+                        return node
+        return None
 
     def __unicode__(self):
         return self.name
 
     def toxml(self):
-        raise NotImplementedError
+        return serializer.toString(self, "xml")
+
+    def hilite(self):
+        return serializer.toString(self, "hilite")
 
     def printTree(self, indent=0):
-        tree = '\n|%s%s' % (' '* indent, unicode(self))
-        for child in self.childNodes:
-            tree += child.printTree(indent + 2)
-        return tree
+        return u"".join(serializer.walkTree(self, indent))
+
+    def serialize(self, stream, encoding="utf-8", method="xml"):
+        """Writes the node to stream as "xml", "hilite" or "tree"."""
+        serializer.serialize(self, stream, encoding, method)
 
     def appendChild(self, node, index=None):
         if (isinstance(node, Text) and self.childNodes and
           isinstance(self.childNodes[-1], Text)):
-            self.childNodes[-1].value += node.value
+            self.childNodes[-1].appendData(node.value)
         else:
             self.childNodes.append(node)
         node.parent = self
 
     def insertText(self, data):
         self.appendChild(Text(data))
+        return self.childNodes[-1]
+
+    def removeChild(self, node):
+        # Usually the node is the last child, when it has just been parsed
+        if self.childNodes and self.childNodes[-1] is node:
+            self.childNodes.pop()
+        else:
+            for i in xrange(len(self.childNodes) - 1, -1, -1):
+                if self.childNodes[i] is node:
+                    del self.childNodes[i]
+                    break
+            else:
+                raise ValueError("node is not a child of this node")
+        node.parent = None
+
+    def clear(self):
+        """Removes all children. Attributes are kept."""
+        if self.childNodes:
+            for node in self.childNodes:
+                node.parent = None
+            del self.childNodes[:]
 
     def hasContent(self):
         """Return true if the node has children or text"""
         return bool(self.childNodes)
 
 class Document(Node):
+    __slots__ = ("childNodes", "index")
+    nodeType = serializer.DOCUMENT_NODE
+
     def __init__(self):
         Node.__init__(self)
+        self.childNodes = []
+        # The ElementIndex of documents built by IndexedTreeBuilder
+        self.index = None
+
+    def contains(self, node):
+        """Returns whether node is in the document."""
+        while node is not None:
+            if node is self:
+                return True
+            node = node.parent
+        return False
+
+    # With an index the lookups only walk the tree when the index has
+    # nothing, as the element may have been added after it was built
+
+    def getElementsByTagName(self, name):
+        if self.index is not None:
+            elements = self.index.find(self.index.byName, name, self)
+            if elements:
+                return elements
+        return Node.getElementsByTagName(self, name)
+
+    def getElementsByTagNameNS(self, namespace, localname):
+        if self.index is not None:
+            key = (namespace or "", localname)
+            elements = self.index.find(self.index.byNamespace, key, self)
+            if elements:
+                return elements
+        return Node.getElementsByTagNameNS(self, namespace, localname)
+
+    def getElementById(self, id):
+        if self.index is not None:
+            elements = self.index.find(self.index.byId, id, self)
+            if elements:
+                return elements[0]
+        return Node.getElementById(self, id)
+
+    def reindex(self):
+        """Indexes the elements of the document as it is now, for instance
+        after elements were added to a document built by
+        IndexedTreeBuilder."""
+        index = ElementIndex()
+        for node in self:
+            if node.nodeType == serializer.ELEMENT_NODE:
+                index.add(node)
+        self.index = index
 
     def __unicode__(self):
         return "#document"
 
-    def toxml(self, encoding="utf=8"):
-        result = ""
-        for child in self.childNodes:
-            result += child.toxml()
-        return result.encode(encoding)
+    def toxml(self, encoding="utf-8"):
+        return serializer.toString(self, "xml").encode(encoding)
 
     def hilite(self, encoding="utf-8"):
-        result = "<pre>"
-        for child in self.childNodes:
-            result += child.hilite()
-        return result.encode(encoding) + "</pre>"
-    
+        return "<pre>" + serializer.toString(self, "hilite").encode(encoding) +\
+          "</pre>"
+
     def printTree(self):
-        tree = unicode(self)
-        for child in self.childNodes:
-            tree += child.printTree(1)
-        return tree
+        return unicode(self) + u"".join(serializer.walkTree(self))
 
 class Text(Node):
+    # Text appended to the node is kept as a list of pieces until value is
+    # read, so text that arrives in many tokens takes linear time to merge
+    __slots__ = ("text", "pieces")
+    nodeType = serializer.TEXT_NODE
+    childNodes = ()
+
     def __init__(self, value):
         Node.__init__(self)
-        self.value = value
+        self.text = value
+        self.pieces = None
 
-    def __unicode__(self):
-        return "\"%s\"" % self.value
+    def getValue(self):
+        if self.pieces is not None:
+            self.text = "".join(self.pieces)
+            self.pieces = None
+        return self.text
 
-    def toxml(self):
-        return escape(self.value)
+    def setValue(self, value):
+        self.text = value
+        self.pieces = None
+
+    value = property(getValue, setValue)
 
-    hilite = toxml
+    def appendData(self, data):
+        if self.pieces is None:
+            self.pieces = [self.text]
+        self.pieces.append(data)
+
+    def __unicode__(self):
+        return "\"%s\"" % self.value
 
 class Element(Node):
+    __slots__ = ("name", "prefix", "localname", "namespace", "attributes",
+      "childNodes")
+    nodeType = serializer.ELEMENT_NODE
+
     def __init__(self, name, prefix, localname, namespace, attributes):
         Node.__init__(self)
+        self.childNodes = []
         self.name = name
         self.prefix = prefix
         self.localname = localname
@@ -90,17 +233,11 @@ class Element(Node):
     def __unicode__(self):
         return "<%s>" % self.name
 
-    def printTree(self, indent):
-        tree = '\n|%s<%s> (%s, %s, %s)' % (' '*indent, self.name, self.prefix, self.localname, self.namespace)
-        indent += 2
-        if self.attributes:
-            for token in sorted(self.attributes, key=lambda token: token["name"]):
-                tree += '\n|%s%s="%s" (%s, %s, %s)' % (' ' * indent, token["name"], token["value"], token["prefix"], token["localname"], token["namespace"])
-        for child in self.childNodes:
-            tree += child.printTree(indent)
-        return tree
-
 class Pi(Node):
+    __slots__ = ("name", "data")
+    nodeType = serializer.PROCESSING_INSTRUCTION_NODE
+    childNodes = ()
+
     def __init__(self, name, data):
         Node.__init__(self)
         self.name = name
@@ -109,25 +246,67 @@ class Pi(Node):
     def __unicode__(self):
         return "<?%s %s?>" % (self.name, self.data)
 
-    def toxml(self):
-        return "<?%s %s?>" % (self.name, self.data)
-
-    def hilite(self):
-        return '<code class="markup pi">&lt;?%s %s?></code>' % (escape(self.name), escape(self.data))
-
 class Comment(Node):
+    __slots__ = ("data",)
+    nodeType = serializer.COMMENT_NODE
+    childNodes = ()
+
     def __init__(self, data):
         Node.__init__(self)
         self.data = data
 
     def __unicode__(self):
         return "<!-- %s -->" % self.data
-    
-    def toxml(self):
-        return "<!--%s-->" % self.data
 
-    def hilite(self):
-        return '<code class="markup comment">&lt;!--%s--></code>' % escape(self.data)
+class ElementIndex(object):
+    """Lists of elements in document order by name, by (namespace,
+    localname) and by ID.
+
+    The index is a snapshot of the document as it was parsed, or as it was
+    at Document.reindex(). Elements that have been removed since are
+    dropped when they are looked up. Elements added since are not in it,
+    so lookups that find nothing walk the tree instead, and lookups that do
+    find elements miss the added ones until the document is reindexed."""
+
+    def __init__(self):
+        self.byName = {}
+        self.byNamespace = {}
+        self.byId = {}
+
+    def add(self, element):
+        self.byName.setdefault(element.name, []).append(element)
+        self.byNamespace.setdefault((element.namespace, element.localname),
+          []).append(element)
+        if element.attributes:
+            for attribute in element.attributes:
+                if attribute.name in idAttributes:
+                    self.byId.setdefault(attribute.value,
+                      []).append(element)
+
+    def find(self, table, key, document):
+        elements = table.get(key)
+        if not elements:
+            return []
+        # The nodes found to be in the document or not, so the parents that
+        # elements share are only walked up from once
+        inside = set([document])
+        outside = set()
+        found = []
+        for element in elements:
+            chain = []
+            node = element
+            while node is not None and node not in inside and\
+              node not in outside:
+                chain.append(node)
+                node = node.parent
+            if node is not None and node in inside:
+                inside.update(chain)
+                found.append(element)
+            else:
+                outside.update(chain)
+        if len(found) != len(elements):
+            table[key] = found
+        return found
 
 class TreeBuilder(_base.TreeBuilder):
     documentClass = Document
@@ -137,3 +316,19 @@ class TreeBuilder(_base.TreeBuilder):
 
     def testSerializer(self, node):
         return node.printTree()
+
+class IndexedTreeBuilder(TreeBuilder):
+    """Indexes the elements while the tree is built so the lookup methods
+    of the document don't have to walk it:
+
+      XMLParser(tree=simpletree.IndexedTreeBuilder)
+    """
+
+    def reset(self):
+        TreeBuilder.reset(self)
+        self.document.index = ElementIndex()
+
+    def insertElement(self, name, attributes):
+        element = TreeBuilder.insertElement(self, name, attributes)
+        self.document.index.add(element)
+        return element